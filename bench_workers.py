@@ -0,0 +1,133 @@
+# Measures update throughput with 1, 2 and 4 shard workers: python bench_workers.py [updates] [chats]
+# Every worker is the real worker_main on a scratch database; only the Bot API is answered locally.
+# Workers share nothing but the database, so the numbers only grow with the worker count when the
+# machine has a CPU core for each of them.
+import itertools
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ["METRICS_PORT"] = "0"
+os.environ["LOOP_STALL_MS"] = "0"
+
+WORKER_COUNTS = (1, 2, 4)
+USERS_PER_CHAT = 20
+
+
+def bench_worker(index, count, updates, db_file, ready, results):
+    # Imported here so the chart workers this process spawns do not load the bot again.
+    import bot
+    from aiogram import types
+    from aiogram.client.session.base import BaseSession
+
+    class NullSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self._message_ids = itertools.count(1)
+
+        async def make_request(self, bot, method, timeout=None):
+            if type(method).__name__.startswith("Send"):
+                return types.Message(message_id=next(self._message_ids), date=datetime.now(),
+                                     chat=types.Chat(id=method.chat_id, type="supergroup"))
+            return True
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+    timings = {"handled": 0, "first": None, "last": None}
+    feed_update, start_services = bot.feed_update, bot.start_services
+
+    async def timed_feed_update(update):
+        if timings["first"] is None:
+            timings["first"] = time.perf_counter()
+        await feed_update(update)
+        timings["handled"] += 1
+        timings["last"] = time.perf_counter()
+
+    async def start_services_then_signal():
+        await start_services()
+        ready.set()
+
+    async def no_warm_up():
+        pass
+
+    bot.DB_FILE = db_file
+    bot.bot.session = NullSession()
+    bot.feed_update = timed_feed_update
+    bot.start_services = start_services_then_signal
+    bot.warm_chart_pool = no_warm_up  # charts are not on the measured path
+    bot.worker_main(index, count, updates)
+    results.put((index, timings["handled"], timings["first"], timings["last"]))
+
+
+def make_database(path, chats):
+    import bot
+    bot.DB_FILE = path
+    bot.init_db()
+    bot.close_db_connections()
+    with sqlite3.connect(path) as conn:
+        conn.executemany("INSERT INTO users (chat_id, user_id, first_name, size) VALUES (?, ?, ?, ?)",
+                         [(-chat, user, f"Player {user}", user) for chat in range(1, chats + 1)
+                          for user in range(1, USERS_PER_CHAT + 1)])
+
+
+def raw_update(update_id, chat_id, user_id):
+    return ('{"update_id": %d, "message": {"message_id": %d, "date": %d, "text": "/me", '
+            '"entities": [{"type": "bot_command", "offset": 0, "length": 3}], '
+            '"chat": {"id": %d, "type": "supergroup", "title": "bench"}, '
+            '"from": {"id": %d, "is_bot": false, "first_name": "Player %d"}}}'
+            % (update_id, update_id, int(time.time()), chat_id, user_id, user_id))
+
+
+def run(count, total, chats, db_file):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    queues = [context.Queue() for _ in range(count)]
+    ready = [context.Event() for _ in range(count)]
+    workers = [context.Process(target=bench_worker, args=(index, count, queues[index], db_file, ready[index], results))
+               for index in range(count)]
+    for worker in workers:
+        worker.start()
+    for event in ready:
+        event.wait()
+
+    for update_id in range(1, total + 1):
+        chat_id = -(update_id % chats + 1)
+        user_id = update_id // chats % USERS_PER_CHAT + 1
+        queues[chat_id % count].put(raw_update(update_id, chat_id, user_id))
+    for updates in queues:
+        updates.put(None)
+
+    stats = [results.get() for _ in range(count)]
+    for worker in workers:
+        worker.join()
+    handled = sum(handled for _, handled, _, _ in stats)
+    elapsed = max(last for _, _, _, last in stats) - min(first for _, _, first, _ in stats)
+    return handled, elapsed
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    chats = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    print(f"{total} /me updates over {chats} chats, {os.cpu_count()} CPUs")
+    with tempfile.TemporaryDirectory() as directory:
+        db_file = os.path.join(directory, "bench.db")
+        make_database(db_file, chats)
+        baseline = None
+        for count in WORKER_COUNTS:
+            handled, elapsed = run(count, total, chats, db_file)
+            rate = handled / elapsed
+            baseline = baseline or rate
+            print(f"{count} worker(s): {handled} updates in {elapsed:.2f}s, {rate:.0f} updates/s, x{rate / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,110 @@
 import asyncio
+import bisect
+import contextlib
+import functools
+import hashlib
 import json
 import logging
 import os
 import random
+import re
+import secrets
+import signal
 import sqlite3
+import sys
+import threading
+import time
+import traceback
+import heapq
 import html
+import inspect
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from typing import Any, Awaitable, Callable, Dict
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+STARTED_AT = time.monotonic()  # before the third-party imports, so startup timings include them
+
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command, CommandObject, CommandStart
-from aiogram.types import FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup, TelegramObject
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, InlineKeyboardButton, InlineKeyboardMarkup, TelegramObject
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+import charts
+import metrics
 
-TOKEN = ""
+TOKEN = os.getenv("BOT_TOKEN", "")
 DOCS_URL = "https://telegra.ph/WombatCombat---help-06-28"
 
+# Webhook mode is used when WEBHOOK_URL (the public https base URL) is set; otherwise the bot long-polls.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# With WORKERS > 1 this process only receives updates and hands each one to the worker process
+# that owns its chat (chat_id % WORKERS); games, timers and caches live in the workers.
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_CHECK_SECONDS = 1.0  # how often the supervisor checks that every worker is still alive
+# Prometheus text metrics on http://METRICS_HOST:METRICS_PORT/metrics (workers use METRICS_PORT + 1 + index).
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 disables the endpoint
+# Opt-in statement profiler: per-statement stats, dumped on SIGUSR1 or from /profile on the metrics
+# server, and a warning with EXPLAIN QUERY PLAN for every statement slower than DB_SLOW_QUERY_MS.
+DB_PROFILE = os.getenv("DB_PROFILE", "0") not in ("", "0")
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "50"))
+# Event-loop stalls longer than this are logged with the blocking stack and counted per handler (0 disables).
+LOOP_STALL_MS = float(os.getenv("LOOP_STALL_MS", "100"))
+
 DB_FILE = "wombat.db"
-CHART_FILE = "chart.png"
-BJ_RESULTS_FILE = "blackjack_results.png"
 GROW_COOLDOWN_HOURS = 24
 TAG_COOLDOWN_SECONDS = 10
 EVENT_CHANCE = 20
 SPAM_COOLDOWN_SECONDS = 2
+SPAM_TRACKED_USERS = 100000  # (chat_id, user_id, bucket) entries kept by the rate limiter
+SPAM_STATE_TTL_SECONDS = 600  # must exceed the slowest bucket refill below
+# Optional per-command token buckets on top of the cooldown, e.g. {"casino": (5, 60)}:
+# command -> (burst, seconds to refill the whole burst).
+COMMAND_RATE_LIMITS: Dict[str, tuple] = {}
 DUEL_ACCEPT_TIMEOUT_SECONDS = 60
 PRESTIGE_REQUIREMENT = 100
 BLACKJACK_TURN_SECONDS = 30
+PLAYER_NAME_CACHE_SIZE = 50000
+TOP_CHART_CACHE_SIZE = 1024
+TIMER_CONCURRENCY = 64
+TIMER_CALLBACK_TIMEOUT_SECONDS = 120
+CASINO_REVEAL_SECONDS = 3
+DUEL_REVEAL_SECONDS = 2
+BLACKJACK_DEAL_SECONDS = 2
+BLACKJACK_DEALER_FIRST_CARD_SECONDS = 2
+BLACKJACK_DEALER_CARD_SECONDS = 1.5
+BLACKJACK_NEXT_TURN_SECONDS = 1
+
+DB_CACHED_STATEMENTS = 256
+DB_PRAGMAS = (
+    "journal_mode = WAL",
+    "synchronous = NORMAL",
+    "cache_size = -16000",  # ~16 MB page cache
+    "mmap_size = 268435456",  # 256 MB
+    "temp_store = MEMORY",
+    "busy_timeout = 5000",
+)
+DB_READ_THREADS = 4
+DB_WRITE_FLUSH_INTERVAL = 0.002  # seconds the writer waits to gather more writes into one commit
+DB_WRITE_MAX_BATCH = 256
+EDIT_CHAT_INTERVAL_SECONDS = 1.0
+EDIT_GLOBAL_RATE = 25  # edits per second across all chats
+CHART_RENDER_WORKERS = 2
+CHART_QUEUE_LIMIT = 8  # renders queued or running before requests fall back to text
+DB_PROFILE_SAMPLES = 1024  # latest timings kept per statement for the p99
+LOOP_HEARTBEAT_SECONDS = 0.05
+LOOP_STALL_STACK_DEPTH = 12
 
 # --- Localization Strings ---
 LANGUAGES = {
@@ -153,15 +228,516 @@ HUMILIATION_PHRASES = [
     "Тише будь, а то вилкой в глаз кольну.", "Твой жалкий лепет здесь никого не интересует."
 ]
 
+# --- Caches ---
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+class RateLimiter:
+    # Token buckets keyed by (chat_id, user_id, bucket) with monotonic timestamps. Entries are kept in
+    # last-touch order, so idle ones expire from the front and max_size bounds memory.
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._buckets = OrderedDict()  # key -> (tokens, monotonic time of last refill)
+        self.hits = 0
+        self.misses = 0
+        self.limited = 0
+        self.evicted = 0
+
+    def allow(self, key, burst: int, period: float) -> bool:
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._buckets.get(key)
+        if entry is None:
+            self.misses += 1
+            tokens = burst
+        else:
+            self.hits += 1
+            self._buckets.move_to_end(key)
+            tokens = min(burst, entry[0] + (now - entry[1]) * burst / period)
+        if tokens < 1:
+            self.limited += 1
+            self._buckets[key] = (tokens, now)
+            return False
+        self._buckets[key] = (tokens - 1, now)
+        if len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+            self.evicted += 1
+        return True
+
+    def _expire(self, now: float):
+        buckets = self._buckets
+        while buckets:
+            key, (_, stamp) = next(iter(buckets.items()))
+            if now - stamp < self.ttl:
+                break
+            del buckets[key]
+            self.evicted += 1
+
+    # Every entry is a 3-tuple key and a 2-tuple value, so their size is fixed and the memory estimate
+    # needs no walk over the buckets; stats() is scraped with the metrics and must stay O(1).
+    ENTRY_BYTES = sys.getsizeof((0, 0, "")) + sys.getsizeof((0.0, 0.0))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._buckets),
+            "bytes": sys.getsizeof(self._buckets) + len(self._buckets) * self.ENTRY_BYTES,
+            "hits": self.hits,
+            "misses": self.misses,
+            "limited": self.limited,
+            "evicted": self.evicted,
+        }
+
+class Leaderboard:
+    # Per-chat sizes kept in a list sorted by (-size, user_id), so the top slice is a list slice
+    # and rank is a bisect. Updated at every place that changes a user's size.
+    def __init__(self):
+        self._sizes: Dict[int, Dict[int, int]] = {}
+        self._order: Dict[int, list] = {}
+
+    def set_size(self, chat_id: int, user_id: int, size: int):
+        user_id = int(user_id)
+        sizes = self._sizes.setdefault(chat_id, {})
+        order = self._order.setdefault(chat_id, [])
+        old = sizes.get(user_id)
+        if old == size:
+            return
+        if old is not None:
+            del order[bisect.bisect_left(order, (-old, user_id))]
+        sizes[user_id] = size
+        bisect.insort(order, (-size, user_id))
+
+    def top(self, chat_id: int, limit: int):
+        return [(user_id, -neg_size) for neg_size, user_id in self._order.get(chat_id, [])[:limit]]
+
+    def rank(self, chat_id: int, user_id: int):
+        # Returns (rank, total); players with equal size share the best rank.
+        size = self._sizes.get(chat_id, {}).get(int(user_id))
+        if size is None:
+            return None
+        order = self._order[chat_id]
+        return bisect.bisect_left(order, (-size,)) + 1, len(order)
+
+    def load(self, rows):
+        self._sizes.clear()
+        self._order.clear()
+        for row in rows:
+            self._sizes.setdefault(row['chat_id'], {})[row['user_id']] = row['size'] or 0
+        for chat_id, sizes in self._sizes.items():
+            self._order[chat_id] = sorted((-size, user_id) for user_id, size in sizes.items())
+
+# --- Timers ---
+class TimerScheduler:
+    # Min-heap of deadlines (unix time). Each key has at most one live timer: scheduling a key again
+    # replaces its deadline, and replaced or cancelled heap entries are skipped when they surface.
+    def __init__(self, concurrency: int, callback_timeout: float):
+        self._heap = []
+        self._timers = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        # Due callbacks run as independent tasks, at most `concurrency` at a time, so a slow or
+        # rate-limited chat cannot hold up timeouts in the other chats.
+        self._slots = asyncio.Semaphore(concurrency)
+        self._callback_timeout = callback_timeout
+        self._running = set()
+
+    def schedule(self, key, when: datetime, callback: Callable[..., Awaitable[Any]], *args):
+        deadline = when.timestamp()
+        seq = next(self._seq)
+        self._timers[key] = (seq, callback, args)
+        heapq.heappush(self._heap, (deadline, seq, key))
+        if self._heap[0][1] == seq:
+            self._wakeup.set()
+
+    def call_later(self, key, delay: float, callback: Callable[..., Awaitable[Any]], *args):
+        self.schedule(key, datetime.now() + timedelta(seconds=delay), callback, *args)
+
+    def cancel(self, key):
+        self._timers.pop(key, None)
+
+    def count(self, kind) -> int:
+        return sum(1 for key in self._timers if key[1] == kind)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def __len__(self):
+        return len(self._timers)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, seq, key = heapq.heappop(self._heap)
+                timer = self._timers.get(key)
+                if timer is None or timer[0] != seq:
+                    continue
+                del self._timers[key]
+                timer_lateness.observe(now - deadline, key[1])
+                task = asyncio.create_task(self._fire(key, timer[1], timer[2]))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, key, callback, args):
+        try:
+            async with self._slots:
+                with timer_seconds.time(key[1]):
+                    await asyncio.wait_for(callback(*args), self._callback_timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Timer {key} did not finish within {self._callback_timeout} seconds and was cancelled.")
+        except (json.JSONDecodeError, KeyError) as e:
+            logging.error(f"Error processing timer {key} due to bad data: {e}. Resetting relevant state might be needed.")
+        except TelegramBadRequest as e:
+            logging.error(f"Telegram API error for timer {key}: {e}")
+        except Exception as e:
+            logging.error(f"An unexpected error occurred while processing timer {key}: {e}", exc_info=True)
+
+# --- Outbound Edits ---
+class EditQueue:
+    # Coalesces message edits: only the latest pending edit per (chat_id, message_id) is sent,
+    # each chat gets at most one edit per chat_interval and all chats share a global rate.
+    def __init__(self, chat_interval: float, global_rate: float):
+        self.chat_interval = chat_interval
+        self.global_interval = 1 / global_rate
+        self._pending: Dict[int, Dict[int, dict]] = {}  # chat_id -> message_id -> edit kwargs
+        self._chat_next: Dict[int, float] = {}  # chat_id -> monotonic time of its next allowed edit
+        self._heap = []  # (ready_at, seq, chat_id) for chats with pending edits and none in flight
+        self._seq = itertools.count()
+        self._sending = set()
+        self._tasks = set()
+        self._global_next = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def pending(self) -> int:
+        return sum(len(chat_pending) for chat_pending in self._pending.values())
+
+    def edit(self, chat_id: int, message_id: int, text: str, reply_markup=None):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        chat_pending = self._pending.get(chat_id)
+        if chat_pending is None:
+            chat_pending = self._pending[chat_id] = {}
+            if chat_id not in self._sending:
+                self._push(chat_id)
+        chat_pending[message_id] = {"text": text, "reply_markup": reply_markup}
+
+    def discard(self, chat_id: int, message_id: int):
+        # Drops a pending edit of a message that is about to be deleted or edited directly, so a stale
+        # edit cannot land on it afterwards. An edit already in flight is not recalled. The chat's
+        # entry stays (possibly empty) until _run reaches it, so the chat is never queued twice.
+        chat_pending = self._pending.get(chat_id)
+        if chat_pending:
+            chat_pending.pop(message_id, None)
+
+    def _push(self, chat_id):
+        ready_at = max(time.monotonic(), self._chat_next.get(chat_id, 0.0))
+        heapq.heappush(self._heap, (ready_at, next(self._seq), chat_id))
+        if self._heap[0][2] == chat_id:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            if not self._heap:
+                self._chat_next = {chat_id: t for chat_id, t in self._chat_next.items() if t > now}
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = max(self._heap[0][0], self._global_next) - now
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, chat_id = heapq.heappop(self._heap)
+            chat_pending = self._pending[chat_id]
+            if not chat_pending:
+                del self._pending[chat_id]  # all of its edits were discarded
+                continue
+            message_id = next(iter(chat_pending))
+            kwargs = chat_pending.pop(message_id)
+            if not chat_pending:
+                del self._pending[chat_id]
+            self._global_next = now + self.global_interval
+            self._sending.add(chat_id)
+            task = asyncio.create_task(self._send(chat_id, message_id, kwargs))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, chat_id, message_id, kwargs):
+        delay = self.chat_interval
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, **kwargs)
+        except TelegramRetryAfter as e:
+            logging.warning(f"Flood control in chat {chat_id}, retrying edit of message {message_id} in {e.retry_after}s")
+            # A newer edit queued meanwhile supersedes this one.
+            self._pending.setdefault(chat_id, {}).setdefault(message_id, kwargs)
+            delay = e.retry_after
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logging.warning(f"Failed to edit message {message_id} in chat {chat_id}: {e}")
+        except Exception as e:
+            logging.error(f"Failed to edit message {message_id} in chat {chat_id}: {e}", exc_info=True)
+        self._chat_next[chat_id] = time.monotonic() + delay
+        self._sending.discard(chat_id)
+        if chat_id in self._pending:
+            self._push(chat_id)
+
+# --- Loop Watchdog ---
+class LoopWatchdog:
+    # A heartbeat task stamps the time every `interval`; a thread checks the stamp and, while the loop
+    # is stuck, samples the loop thread's stack. The innermost watched function on that stack names
+    # the culprit. When the heartbeat gets through again it reports the stall with its real length.
+    def __init__(self, interval: float, threshold: float, depth: int):
+        self.interval = interval
+        self.threshold = threshold
+        self.depth = depth
+        self._names = {}  # code object -> handler name
+        self._beat = time.monotonic()
+        self._stall = None  # (beat it was seen at, handler name, stack)
+        self._loop_thread = None
+        self._stopped = threading.Event()
+
+    def watch(self, *callbacks):
+        for callback in callbacks:
+            function = inspect.unwrap(callback)
+            self._names[function.__code__] = function.__name__
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._check, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    async def _heartbeat(self):
+        while not self._stopped.is_set():
+            beat = self._beat
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = now - beat - self.interval
+            self._beat = now
+            loop_lag.observe(max(lag, 0.0))
+            stall, self._stall = self._stall, None
+            if lag < self.threshold:
+                continue
+            name, stack = stall[1:] if stall and stall[0] == beat else ("unknown", "")
+            loop_stalls.inc(name)
+            logging.warning(f"Event loop blocked for {lag * 1000:.0f} ms in {name}.\n{stack}".rstrip())
+
+    def _check(self):
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            if self._stall or time.monotonic() - beat < self.interval + self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            name = "unknown"
+            current = frame
+            while current is not None:
+                if current.f_code in self._names:
+                    name = self._names[current.f_code]
+                    break
+                current = current.f_back
+            stack = "".join(traceback.format_stack(frame, limit=self.depth))
+            self._stall = (beat, name, stack)
+
+# --- Metrics ---
+registry = metrics.Registry()
+handler_seconds = registry.histogram("bot_handler_seconds", "Time spent in update handlers.", ("kind", "handler"))
+handler_errors = registry.counter("bot_handler_errors_total", "Update handlers that raised.", ("kind", "handler", "error"))
+db_statement_seconds = registry.histogram("bot_db_statement_seconds", "SQLite statement execution time.", ("statement",))
+telegram_api_seconds = registry.histogram("bot_telegram_api_seconds", "Telegram Bot API call latency.", ("method",))
+telegram_api_errors = registry.counter("bot_telegram_api_errors_total", "Failed Telegram Bot API calls.", ("method", "error"))
+timer_lateness = registry.histogram("bot_timer_lateness_seconds", "Delay between a timer's deadline and its firing.", ("kind",))
+timer_seconds = registry.histogram("bot_timer_callback_seconds", "Timer callback run time.", ("kind",))
+loop_lag = registry.histogram("bot_loop_lag_seconds", "How late the event loop heartbeat woke up.")
+loop_stalls = registry.counter("bot_loop_stalls_total", "Event loop stalls over LOOP_STALL_MS.", ("handler",))
+registry.gauge("bot_active_blackjack_games", "Blackjack games in memory.", lambda: len(blackjack_games))
+registry.gauge("bot_active_duels", "Duels waiting for an answer.", lambda: scheduler.count('duel'))
+registry.gauge("bot_active_trials", "Trials being voted on.", lambda: scheduler.count('trial'))
+registry.gauge("bot_pending_timers", "Armed timers.", lambda: len(scheduler))
+registry.gauge("bot_pending_edits", "Message edits waiting in the edit queue.", lambda: edit_queue.pending())
+registry.gauge("bot_chart_jobs", "Chart renders queued or running.", lambda: _chart_jobs)
+registry.gauge("bot_rate_limiter", "Anti-spam rate limiter state.",
+               lambda: {(name,): value for name, value in rate_limiter.stats().items()}, ("stat",))
+
+@functools.lru_cache(maxsize=1024)
+def normalize_statement(query: str) -> str:
+    # One label per statement shape: whitespace collapsed and IN (?, ?, ...) lists folded.
+    return re.sub(r"\(\?(?:\s*,\s*\?)*\)", "(?...)", " ".join(query.split()))
+
+class QueryProfiler:
+    # Fed by _execute from the DB threads. The plan of a slow statement is looked up once per shape,
+    # on the connection that ran it.
+    def __init__(self, slow_seconds: float, samples: int):
+        self.slow_seconds = slow_seconds
+        self.samples = samples
+        self._stats = {}  # statement -> [calls, total seconds, rows, deque of latest timings]
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def record(self, conn, statement, query, params, elapsed, rows):
+        with self._lock:
+            stats = self._stats.get(statement)
+            if stats is None:
+                stats = self._stats[statement] = [0, 0.0, 0, deque(maxlen=self.samples)]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += rows
+            stats[3].append(elapsed)
+        if elapsed >= self.slow_seconds:
+            logging.warning(f"Slow query ({elapsed * 1000:.1f} ms, {rows} rows): {statement} {params!r}\n"
+                            f"{self._plan(conn, statement, query, params)}")
+
+    def _plan(self, conn, statement, query, params):
+        plan = self._plans.get(statement)
+        if plan is None:
+            try:
+                rows = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+                plan = "\n".join(f"  {row['detail'] if isinstance(row, dict) else row[-1]}" for row in rows)
+            except sqlite3.Error as e:
+                plan = f"  (no plan: {e})"
+            self._plans[statement] = plan
+        return plan
+
+    def report(self) -> str:
+        with self._lock:
+            stats = [(statement, calls, total, rows, sorted(timings))
+                     for statement, (calls, total, rows, timings) in self._stats.items()]
+        stats.sort(key=lambda item: item[2], reverse=True)
+        lines = [f"{'calls':>8} {'total ms':>10} {'mean ms':>8} {'p99 ms':>8} {'rows':>9}  statement"]
+        for statement, calls, total, rows, timings in stats:
+            p99 = timings[int(0.99 * (len(timings) - 1))]
+            lines.append(f"{calls:>8} {total * 1000:>10.1f} {total / calls * 1000:>8.2f} {p99 * 1000:>8.2f} "
+                         f"{rows:>9}  {statement}")
+        return "\n".join(lines)
+
+def dump_query_profile():
+    logging.info(f"Query profile:\n{db_profiler.report()}")
+
+# --- Concurrency ---
+class KeyedLocks:
+    # One asyncio.Lock per key, created on first use and dropped as soon as nobody holds or waits
+    # for it, so idle chats cost nothing.
+    def __init__(self):
+        self._locks: Dict[Any, list] = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
 dp = Dispatcher()
 bot = Bot(TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-user_last_message_time = {}
+rate_limiter = RateLimiter(SPAM_TRACKED_USERS, SPAM_STATE_TTL_SECONDS)
+shard_index, shard_count = 0, 1  # set in worker processes; a single process owns every chat
+metrics_runner: web.AppRunner | None = None
+db_profiler = QueryProfiler(DB_SLOW_QUERY_MS / 1000, DB_PROFILE_SAMPLES) if DB_PROFILE else None
+chat_languages: Dict[int, str] = {}
+player_names = LRUCache(PLAYER_NAME_CACHE_SIZE)  # (chat_id, user_id) -> raw display name
+top_charts = LRUCache(TOP_CHART_CACHE_SIZE)  # content hash of a rendered /top chart -> Telegram file_id
+leaderboard = Leaderboard()
+trial_tallies: Dict[tuple, Dict[str, int]] = {}  # (chat_id, trial_id) -> running vote counts
+chat_locks = KeyedLocks()
+blackjack_games = {}  # chat_id -> BlackjackGame
+scheduler = TimerScheduler(TIMER_CONCURRENCY, TIMER_CALLBACK_TIMEOUT_SECONDS)
+edit_queue = EditQueue(EDIT_CHAT_INTERVAL_SECONDS, EDIT_GLOBAL_RATE)
+loop_watchdog = LoopWatchdog(LOOP_HEARTBEAT_SECONDS, LOOP_STALL_MS / 1000, LOOP_STALL_STACK_DEPTH)
 
 # --- Helper Functions ---
 
-def get_lang(chat_id: int) -> str:
-    lang_data = db_query("SELECT language FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
-    return lang_data['language'] if lang_data and lang_data.get('language') else 'ru'
+async def get_lang(chat_id: int) -> str:
+    # Languages only change through set_language_callback, which updates the cache directly,
+    # so a cached value (including the 'ru' default for unknown chats) never goes stale.
+    lang = chat_languages.get(chat_id)
+    if lang is None:
+        lang_data = await adb_query("SELECT language FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
+        lang = lang_data['language'] if lang_data and lang_data.get('language') else 'ru'
+        chat_languages[chat_id] = lang
+    return lang
+
+def owns_chat(chat_id: int) -> bool:
+    return chat_id % shard_count == shard_index
+
+async def load_language_cache():
+    rows = await adb_query("SELECT chat_id, language FROM chats", fetchall=True)
+    rows = [row for row in rows if owns_chat(row['chat_id'])]
+    for row in rows:
+        chat_languages[row['chat_id']] = row['language'] or 'ru'
+    logging.info(f"Language cache loaded for {len(rows)} chats.")
+
+async def load_leaderboard():
+    rows = await adb_query("SELECT chat_id, user_id, size FROM users", fetchall=True)
+    rows = [row for row in rows if owns_chat(row['chat_id'])]
+    leaderboard.load(rows)
+    logging.info(f"Leaderboard loaded with {len(rows)} players.")
+
+def serialized(kind: str):
+    # Runs the wrapped handler or timer callback under the (chat_id, kind) lock, so state transitions
+    # of one chat's game, duel or trial never interleave while other chats run in parallel.
+    # Only entry points are wrapped; helpers they call must not take the same lock again.
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(event, *args, **kwargs):
+            if isinstance(event, types.CallbackQuery):
+                chat_id = event.message.chat.id
+            elif isinstance(event, types.Message):
+                chat_id = event.chat.id
+            else:
+                chat_id = event
+            async with chat_locks.hold((chat_id, kind)):
+                return await handler(event, *args, **kwargs)
+        return wrapper
+    return decorator
 
 def t(key: str, lang: str, **kwargs) -> str:
     return LANGUAGES.get(lang, LANGUAGES['ru']).get(key, key).format(**kwargs)
@@ -183,6 +759,8 @@ def init_db():
         except sqlite3.OperationalError:
             cursor.execute("ALTER TABLE users ADD COLUMN medals INTEGER DEFAULT 0")
             logging.info("Column 'medals' added to 'users' table.")
+        # Covers the per-chat leaderboard: ORDER BY size in /top and rank counting in /me.
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_chat_size ON users (chat_id, size)")
 
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS chats (
@@ -197,6 +775,30 @@ def init_db():
             cursor.execute("ALTER TABLE chats ADD COLUMN language TEXT DEFAULT 'ru'")
             logging.info("Column 'language' added to 'chats' table.")
 
+        # One row per vote; trial_id is the message_id of the trial announcement.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS trial_votes (
+                chat_id INTEGER, trial_id INTEGER, user_id INTEGER, vote TEXT,
+                PRIMARY KEY (chat_id, trial_id, user_id)
+            ) WITHOUT ROWID
+        ''')
+        # Trials started before trial_votes existed kept their voter lists inside active_trial_json.
+        legacy_trials = cursor.execute(
+            "SELECT chat_id, active_trial_json FROM chats WHERE active_trial_json LIKE '%\"votes\"%'").fetchall()
+        for chat_id, trial_json in legacy_trials:
+            try:
+                trial = json.loads(trial_json)
+                for vote, user_ids in trial.pop('votes').items():
+                    cursor.executemany(
+                        "INSERT OR IGNORE INTO trial_votes (chat_id, trial_id, user_id, vote) VALUES (?, ?, ?, ?)",
+                        [(chat_id, trial['message_id'], user_id, vote) for user_id in user_ids])
+            except (json.JSONDecodeError, KeyError, AttributeError) as e:
+                logging.error(f"Could not migrate trial votes in chat {chat_id}: {e}")
+                continue
+            cursor.execute("UPDATE chats SET active_trial_json = ? WHERE chat_id = ?", (json.dumps(trial), chat_id))
+        if legacy_trials:
+            logging.info(f"Moved votes of {len(legacy_trials)} active trials into 'trial_votes'.")
+
         conn.commit()
 
 def dict_factory(cursor, row):
@@ -205,82 +807,406 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
-def db_query(query, params=(), fetchone=False, fetchall=False, commit=True):
-    with sqlite3.connect(DB_FILE) as conn:
+_db_local = threading.local()
+_db_connections = []
+_db_connections_lock = threading.Lock()
+
+def get_db_connection() -> sqlite3.Connection:
+    # Each DB thread keeps its own long-lived connection. sqlite3 keeps a per-connection
+    # LRU of prepared statements (cached_statements), so repeated queries skip re-parsing.
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS,
+                               isolation_level=None)
         conn.row_factory = dict_factory
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        result = None
-        if fetchone:
-            result = cursor.fetchone()
-        if fetchall:
-            result = cursor.fetchall()
-        if commit:
-            conn.commit()
+        for pragma in DB_PRAGMAS:
+            conn.execute(f"PRAGMA {pragma}")
+        if getattr(_db_local, 'read_only', False):
+            conn.execute("PRAGMA query_only = ON")
+        _db_local.conn = conn
+        with _db_connections_lock:
+            _db_connections.append(conn)
+    return conn
+
+def close_db_connections():
+    with _db_connections_lock:
+        for conn in _db_connections:
+            conn.close()
+        _db_connections.clear()
+
+def _execute(conn, query, params=(), fetchone=False, fetchall=False):
+    started = time.perf_counter()
+    cursor = conn.execute(query, params)
+    result = None
+    if fetchone:
+        result = cursor.fetchone()
+    if fetchall:
+        result = cursor.fetchall()
+    rows = cursor.rowcount
+    cursor.close()
+    elapsed = time.perf_counter() - started
+    statement = normalize_statement(query)
+    db_statement_seconds.observe(elapsed, statement)
+    if db_profiler:
+        if fetchone or fetchall:
+            rows = len(result) if fetchall else int(result is not None)
+        db_profiler.record(conn, statement, query, params, elapsed, max(rows, 0))
     return result
 
+def db_query(query, params=(), fetchone=False, fetchall=False, commit=True):
+    # Connections run in autocommit mode, so `commit` is kept only for call compatibility.
+    return _execute(get_db_connection(), query, params, fetchone=fetchone, fetchall=fetchall)
+
+def _mark_read_only_thread():
+    _db_local.read_only = True
+
+def _is_read_query(query: str) -> bool:
+    return query.lstrip()[:6].upper() in ("SELECT", "WITH")
+
+# Reads run on a small pool of read-only connections (WAL lets them proceed while a write is
+# in flight); every mutation goes through the single writer thread below.
+db_read_executor = ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix="db-read",
+                                      initializer=_mark_read_only_thread)
+db_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+def _commit_batch(ops, durable=False):
+    # Runs on the writer thread: one transaction (and one fsync) for the whole batch. Every op gets
+    # its own savepoint so a failing statement only rolls back itself.
+    # Under WAL with synchronous=NORMAL a commit survives a crash of the bot but not a power loss;
+    # a durable batch is committed with synchronous=FULL, which fsyncs the WAL before returning.
+    conn = get_db_connection()
+    results = []
+    if durable:
+        conn.execute("PRAGMA synchronous = FULL")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for op in ops:
+            conn.execute("SAVEPOINT op")
+            try:
+                results.append((True, op(conn)))
+                conn.execute("RELEASE op")
+            except Exception as e:
+                conn.execute("ROLLBACK TO op")
+                conn.execute("RELEASE op")
+                results.append((False, e))
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        if durable:
+            conn.execute("PRAGMA synchronous = NORMAL")
+    return results
+
+class DBWriter:
+    def __init__(self, flush_interval: float, max_batch: int):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.queue: asyncio.Queue | None = None
+        self.task: asyncio.Task | None = None
+
+    def submit(self, op: Callable[[sqlite3.Connection], Any], durable: bool = False) -> asyncio.Future:
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((op, future, durable))
+        return future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.flush_interval > 0:
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            durable = any(item[2] for item in batch)
+            try:
+                results = await loop.run_in_executor(db_write_executor, _commit_batch, [op for op, _, _ in batch], durable)
+            except Exception as e:
+                logging.error(f"DB write batch of {len(batch)} failed: {e}", exc_info=True)
+                results = [(False, e)] * len(batch)
+            for (_, future, _), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    logging.warning(f"DB write failed: {value}")
+                    future.set_exception(value)
+                    future.exception()  # fire-and-forget writes must not warn about unretrieved errors
+
+    async def close(self):
+        if self.task is None:
+            return
+        while not self.queue.empty():
+            await asyncio.sleep(self.flush_interval or 0.01)
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+db_writer = DBWriter(DB_WRITE_FLUSH_INTERVAL, DB_WRITE_MAX_BATCH)
+
+def db_write_nowait(query, params=()):
+    # Queues a write and returns at once; the writer still applies writes in submission order.
+    db_writer.submit(functools.partial(_execute, query=query, params=params))
+
+async def adb_transaction(op: Callable[[sqlite3.Connection], Any], durable: bool = False):
+    # Runs op(conn) on the writer thread as one atomic unit and returns its result.
+    return await db_writer.submit(op, durable)
+
+async def adb_query(query, params=(), fetchone=False, fetchall=False, commit=True, wait=True, durable=False):
+    # Reads go to the read pool. Writes are queued for the writer; by default the caller waits until
+    # its batch is committed, wait=False returns right away (later writes still apply in order).
+    # durable=True also waits until the commit is fsynced, for writes that move size between players.
+    if _is_read_query(query):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            db_read_executor, functools.partial(db_query, query, params, fetchone=fetchone, fetchall=fetchall)
+        )
+    if not wait:
+        db_write_nowait(query, params)
+        return None
+    return await db_writer.submit(functools.partial(_execute, query=query, params=params, fetchone=fetchone, fetchall=fetchall),
+                                  durable)
+
+def remember_player_name(chat_id, user_data) -> str:
+    # Caches the display name from any users row that has first_name and nickname in it.
+    name = user_data.get('nickname') or user_data.get('first_name') or ''
+    player_names.set((chat_id, int(user_data['user_id'])), name)
+    return name
+
+def forget_player_name(chat_id, user_id):
+    player_names.pop((chat_id, int(user_id)))
+
 async def get_player_name(user_id, chat_id):
-    user_data = db_query("SELECT first_name, nickname FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
-    lang = get_lang(chat_id)
-    name = t('unknown_player', lang)
-    if user_data:
-        name = user_data.get('nickname') or user_data.get('first_name')
+    name = player_names.get((chat_id, int(user_id)))
+    if name is None:
+        user_data = await adb_query("SELECT user_id, first_name, nickname FROM users WHERE user_id = ? AND chat_id = ?",
+                                    (user_id, chat_id), fetchone=True)
+        if not user_data:
+            return html.escape(t('unknown_player', await get_lang(chat_id)))
+        name = remember_player_name(chat_id, user_data)
     return html.escape(name)
 
+async def get_player_names(user_ids, chat_id) -> Dict[int, str]:
+    # Resolves many names with at most one query; the result is keyed by int user id.
+    user_ids = [int(uid) for uid in user_ids]
+    names = {}
+    missing = []
+    for uid in user_ids:
+        name = player_names.get((chat_id, uid))
+        if name is None:
+            missing.append(uid)
+        else:
+            names[uid] = name
+    if missing:
+        placeholders = ", ".join("?" * len(missing))
+        rows = await adb_query(
+            f"SELECT user_id, first_name, nickname FROM users WHERE chat_id = ? AND user_id IN ({placeholders})",
+            (chat_id, *missing), fetchall=True)
+        for row in rows:
+            names[row['user_id']] = remember_player_name(chat_id, row)
+        if len(names) < len(set(user_ids)):
+            unknown = t('unknown_player', await get_lang(chat_id))
+            for uid in missing:
+                names.setdefault(uid, unknown)
+    return {uid: html.escape(name) for uid, name in names.items()}
+
+async def count_trial_votes(chat_id: int, trial_id: int) -> Dict[str, int]:
+    row = await adb_query(
+        "SELECT COALESCE(SUM(vote = 'guilty'), 0) AS guilty, COALESCE(SUM(vote = 'innocent'), 0) AS innocent "
+        "FROM trial_votes WHERE chat_id = ? AND trial_id = ?", (chat_id, trial_id), fetchone=True)
+    return {"guilty": row['guilty'], "innocent": row['innocent']}
+
+async def get_trial_tally(chat_id: int, trial_id: int) -> Dict[str, int]:
+    # Counters are seeded from the table once per trial (e.g. after a restart) and then kept in step
+    # with every accepted vote.
+    tally = trial_tallies.get((chat_id, trial_id))
+    if tally is None:
+        tally = trial_tallies[(chat_id, trial_id)] = await count_trial_votes(chat_id, trial_id)
+    return tally
+
 # --- Blackjack Helper Functions ---
-def get_blackjack_game(chat_id):
-    chat_info = db_query("SELECT active_blackjack_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
-    if chat_info and chat_info['active_blackjack_json']:
-        try:
-            return json.loads(chat_info['active_blackjack_json'])
-        except json.JSONDecodeError:
-            return None
-    return None
+# Cards are ints 0..51: suit = card // 13, rank = card % 13.
+CARD_SUITS = ('♥', '♦', '♣', '♠')
+CARD_RANKS = ('2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A')
+CARD_LABELS = tuple(f"{rank}{suit}" for suit in CARD_SUITS for rank in CARD_RANKS)
+CARD_VALUES = tuple(11 if rank == 'A' else 10 if rank in ('J', 'Q', 'K') else int(rank)
+                    for suit in CARD_SUITS for rank in CARD_RANKS)
+ACE_RANK = CARD_RANKS.index('A')
+
+def encode_cards(cards) -> str:
+    return bytes(cards).hex()
+
+def decode_cards(data) -> list:
+    # Snapshots written before the int cards held lists of {'rank', 'suit'} dicts.
+    if isinstance(data, str):
+        return list(bytes.fromhex(data))
+    return [CARD_SUITS.index(card['suit']) * 13 + CARD_RANKS.index(card['rank']) for card in data]
+
+class Hand:
+    # Keeps the hard total (aces counted as 1) and ace count up to date on every add,
+    # so reading the value never rescans the cards.
+    __slots__ = ('cards', 'hard', 'aces')
+
+    def __init__(self, cards=()):
+        self.cards = []
+        self.hard = 0
+        self.aces = 0
+        for card in cards:
+            self.append(card)
+
+    def append(self, card: int):
+        self.cards.append(card)
+        if card % 13 == ACE_RANK:
+            self.aces += 1
+            self.hard += 1
+        else:
+            self.hard += CARD_VALUES[card]
+
+    @property
+    def value(self) -> int:
+        if self.aces and self.hard + 10 <= 21:
+            return self.hard + 10
+        return self.hard
+
+    def __iter__(self):
+        return iter(self.cards)
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __getitem__(self, index):
+        return self.cards[index]
+
+class BlackjackPlayer:
+    __slots__ = ('hand', 'bet', 'status')
+
+    def __init__(self, bet: int, hand: Hand | None = None, status: str = 'playing'):
+        self.hand = hand if hand is not None else Hand()
+        self.bet = bet
+        self.status = status
+
+class BlackjackGame:
+    # Resident game state: the object in blackjack_games is the source of truth while a game runs,
+    # and the JSON in chats.active_blackjack_json is only a snapshot used to recover after a restart.
+    __slots__ = ('state', 'host_id', 'players', 'deck', 'dealer_hand', 'message_id',
+                 'current_player_index', 'end_time', 'expecting_bet_from', 'turn_end_time')
+
+    def __init__(self, host_id: int, end_time: datetime):
+        self.state = 'waiting'
+        self.host_id = host_id
+        self.players: Dict[int, BlackjackPlayer] = {}  # insertion order is turn order
+        self.deck: list[int] = []
+        self.dealer_hand = Hand()
+        self.message_id = None
+        self.current_player_index = 0
+        self.end_time = end_time
+        self.expecting_bet_from = None
+        self.turn_end_time: datetime | None = None
+
+    @property
+    def player_ids(self):
+        return list(self.players)
+
+    def current_player_id(self):
+        player_ids = self.player_ids
+        if self.current_player_index < len(player_ids):
+            return player_ids[self.current_player_index]
+        return None
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "state": self.state,
+            "host_id": self.host_id,
+            "players": {str(uid): {"hand": encode_cards(p.hand), "bet": p.bet, "status": p.status}
+                        for uid, p in self.players.items()},
+            "deck": encode_cards(self.deck),
+            "dealer_hand": encode_cards(self.dealer_hand),
+            "message_id": self.message_id,
+            "current_player_index": self.current_player_index,
+            "end_time": self.end_time.isoformat(),
+            "expecting_bet_from": self.expecting_bet_from,
+            "turn_end_time": self.turn_end_time.isoformat() if self.turn_end_time else None,
+        })
 
-def save_blackjack_game(chat_id, game_data):
-    if game_data:
-        game_json = json.dumps(game_data)
-        db_query(
+    @classmethod
+    def from_json(cls, game_json: str) -> 'BlackjackGame':
+        data = json.loads(game_json)
+        game = cls(data['host_id'], datetime.fromisoformat(data['end_time']))
+        game.state = data['state']
+        game.players = {int(uid): BlackjackPlayer(p['bet'], Hand(decode_cards(p['hand'])), p['status'])
+                         for uid, p in data['players'].items()}
+        game.deck = decode_cards(data['deck'])
+        game.dealer_hand = Hand(decode_cards(data['dealer_hand']))
+        game.message_id = data['message_id']
+        game.current_player_index = data['current_player_index']
+        game.expecting_bet_from = data.get('expecting_bet_from')
+        game.turn_end_time = datetime.fromisoformat(data['turn_end_time']) if data.get('turn_end_time') else None
+        return game
+
+def get_blackjack_game(chat_id) -> BlackjackGame | None:
+    return blackjack_games.get(chat_id)
+
+def save_blackjack_game(chat_id, game: BlackjackGame | None):
+    # Write-behind snapshot: the resident object is updated immediately and the snapshot is queued
+    # for the DB writer without waiting for the commit.
+    if game:
+        blackjack_games[chat_id] = game
+        db_write_nowait(
             "INSERT INTO chats (chat_id, active_blackjack_json) VALUES (?, ?) "
             "ON CONFLICT(chat_id) DO UPDATE SET active_blackjack_json = excluded.active_blackjack_json",
-            (chat_id, game_json)
+            (chat_id, game.to_json())
         )
     else:
-        db_query("UPDATE chats SET active_blackjack_json = NULL WHERE chat_id = ?", (chat_id,))
+        blackjack_games.pop(chat_id, None)
+        db_write_nowait("UPDATE chats SET active_blackjack_json = NULL WHERE chat_id = ?", (chat_id,))
+
+async def load_blackjack_games():
+    rows = await adb_query("SELECT chat_id, active_blackjack_json FROM chats WHERE active_blackjack_json IS NOT NULL",
+                           fetchall=True)
+    for row in rows:
+        if not owns_chat(row['chat_id']):
+            continue
+        try:
+            blackjack_games[row['chat_id']] = BlackjackGame.from_json(row['active_blackjack_json'])
+        except (json.JSONDecodeError, KeyError, ValueError) as e:
+            logging.error(f"Dropping unreadable blackjack game in chat {row['chat_id']}: {e}")
+            save_blackjack_game(row['chat_id'], None)
+    logging.info(f"Recovered {len(blackjack_games)} blackjack games.")
+
+def arm_blackjack_turn_timer(chat_id, game: BlackjackGame):
+    scheduler.schedule((chat_id, 'bj_turn'), game.turn_end_time, on_blackjack_turn_timeout, chat_id)
+
+def start_blackjack_turn_clock(chat_id, game: BlackjackGame):
+    game.turn_end_time = datetime.now() + timedelta(seconds=BLACKJACK_TURN_SECONDS)
+    arm_blackjack_turn_timer(chat_id, game)
 
 def create_deck():
-    suits = ['♥', '♦', '♣', '♠']
-    ranks = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
-    return [{'rank': rank, 'suit': suit} for suit in suits for rank in ranks]
-
-def get_card_value(card):
-    if card['rank'] in ['J', 'Q', 'K']:
-        return 10
-    if card['rank'] == 'A':
-        return 11
-    return int(card['rank'])
-
-def get_hand_value(hand):
-    value = sum(get_card_value(card) for card in hand)
-    num_aces = sum(1 for card in hand if card['rank'] == 'A')
-    while value > 21 and num_aces:
-        value -= 10
-        num_aces -= 1
-    return value
+    return list(range(52))
+
+def get_card_value(card: int) -> int:
+    return CARD_VALUES[card]
 
 def format_hand(hand):
-    return " ".join([f"{card['rank']}{card['suit']}" for card in hand])
+    return " ".join([CARD_LABELS[card] for card in hand])
 
-async def generate_lobby_text(game: Dict, chat_id: int) -> str:
-    lang = get_lang(chat_id)
-    host_name = await get_player_name(game['host_id'], chat_id)
-    end_time = datetime.fromisoformat(game['end_time'])
-    seconds_left = max(0, int((end_time - datetime.now()).total_seconds()))
+async def generate_lobby_text(game: BlackjackGame, chat_id: int) -> str:
+    lang = await get_lang(chat_id)
+    names = await get_player_names([game.host_id, *game.players], chat_id)
+    host_name = names[game.host_id]
+    seconds_left = max(0, int((game.end_time - datetime.now()).total_seconds()))
     
     player_lines = []
-    for uid, pdata in game['players'].items():
-        p_name = await get_player_name(int(uid), chat_id)
-        player_lines.append(t('bj_lobby_player_line', lang, p_name=p_name, bet=pdata['bet']))
+    for uid, player in game.players.items():
+        p_name = names[uid]
+        player_lines.append(t('bj_lobby_player_line', lang, p_name=p_name, bet=player.bet))
 
     if not player_lines:
         player_lines.append(t('bj_lobby_no_players', lang))
@@ -293,22 +1219,143 @@ async def generate_lobby_text(game: Dict, chat_id: int) -> str:
         "\n".join(player_lines)
     )
 
+# --- Charts ---
+def new_chart_executor() -> ProcessPoolExecutor:
+    # Spawned rather than forked: the bot process already runs DB and executor threads. A spawned
+    # worker re-imports the main script, which is why the bot is started through run.py: the
+    # workers then import only charts.
+    return ProcessPoolExecutor(max_workers=CHART_RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=charts.warm_up)
+
+def replace_chart_executor(broken: ProcessPoolExecutor):
+    # A worker that dies (or an initializer that raises) breaks the pool for good; start a new one.
+    global chart_executor
+    if chart_executor is broken:
+        chart_executor = new_chart_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+chart_executor = new_chart_executor()
+_chart_jobs = 0
+
+async def warm_chart_pool():
+    # Starts every render worker in the background after startup, so the first /top or blackjack
+    # result does not pay for process spawn and the matplotlib import.
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    executor = chart_executor
+    try:
+        await asyncio.gather(*(loop.run_in_executor(executor, charts.warm_up) for _ in range(CHART_RENDER_WORKERS)))
+    except Exception as e:
+        logging.error(f"Chart pool warm-up failed: {e}", exc_info=True)
+        if isinstance(e, BrokenProcessPool):
+            replace_chart_executor(executor)
+        return
+    logging.info(f"Chart pool warmed up in {time.monotonic() - started:.2f}s.")
+
+async def render_chart(renderer: Callable[..., bytes], *args) -> bytes | None:
+    # Returns None when the pool is saturated or the render fails; callers then answer with text.
+    global _chart_jobs
+    if _chart_jobs >= CHART_QUEUE_LIMIT:
+        logging.warning(f"Chart queue is full ({_chart_jobs} jobs), skipping {renderer.__name__}.")
+        return None
+    _chart_jobs += 1
+    executor = chart_executor
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, renderer, *args)
+    except BrokenProcessPool as e:
+        logging.error(f"Chart pool is broken ({e}), starting a new one; {renderer.__name__} falls back to text.")
+        replace_chart_executor(executor)
+        return None
+    except Exception as e:
+        logging.error(f"Chart render {renderer.__name__} failed: {e}", exc_info=True)
+        return None
+    finally:
+        _chart_jobs -= 1
+
 # --- Middlewares ---
+first_update_logged = False
+
+@dp.update.outer_middleware()
+async def startup_timing_middleware(
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: Dict[str, Any]
+) -> Any:
+    global first_update_logged
+    if not first_update_logged:
+        first_update_logged = True
+        logging.info(f"First update received {time.monotonic() - STARTED_AT:.2f}s after process start.")
+    return await handler(event, data)
+
 @dp.message.middleware()
 async def anti_spam_middleware(
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
         event: types.Message,
         data: Dict[str, Any]
 ) -> Any:
-    user_id = event.from_user.id
-    current_time = datetime.now()
-    if user_id in user_last_message_time:
-        time_diff = current_time - user_last_message_time[user_id]
-        if time_diff < timedelta(seconds=SPAM_COOLDOWN_SECONDS):
+    chat_id, user_id = event.chat.id, event.from_user.id
+    if not rate_limiter.allow((chat_id, user_id, None), 1, SPAM_COOLDOWN_SECONDS):
+        return
+    if event.text and event.text.startswith('/'):
+        command = event.text.split(maxsplit=1)[0][1:].split('@')[0].lower()
+        limit = COMMAND_RATE_LIMITS.get(command)
+        if limit and not rate_limiter.allow((chat_id, user_id, command), *limit):
             return
-    user_last_message_time[user_id] = current_time
     return await handler(event, data)
 
+async def metrics_middleware(
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+) -> Any:
+    kind = "callback" if isinstance(event, types.CallbackQuery) else "message"
+    name = data["handler"].callback.__name__
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception as e:
+        handler_errors.inc(kind, name, type(e).__name__)
+        raise
+    finally:
+        handler_seconds.observe(time.perf_counter() - started, kind, name)
+
+dp.message.middleware(metrics_middleware)
+dp.callback_query.middleware(metrics_middleware)
+
+@bot.session.middleware()
+async def telegram_api_metrics_middleware(make_request, bot: Bot, method):
+    name = type(method).__name__
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        telegram_api_errors.inc(name, type(e).__name__)
+        raise
+    finally:
+        telegram_api_seconds.observe(time.perf_counter() - started, name)
+
+async def start_metrics_server() -> web.AppRunner | None:
+    if not METRICS_PORT:
+        return None
+    port = METRICS_PORT + (shard_index + 1 if shard_count > 1 else 0)
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def handle_profile(request: web.Request) -> web.Response:
+        if not db_profiler:
+            raise web.HTTPNotFound(text="Query profiler is off, start with DB_PROFILE=1.")
+        return web.Response(text=db_profiler.report() + "\n", content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    app.router.add_get("/profile", handle_profile)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logging.info(f"Metrics available on http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
 # --- Command Handlers ---
 async def get_target_id_from_message(message: types.Message, chat_id: int) -> str | None:
     if message.reply_to_message and not message.reply_to_message.from_user.is_bot:
@@ -320,7 +1367,7 @@ async def get_target_id_from_message(message: types.Message, chat_id: int) -> st
                     return str(entity.user.id)
                 elif entity.type == 'mention':
                     mentioned_username = message.text[entity.offset + 1:entity.offset + entity.length].lower()
-                    user = db_query("SELECT user_id FROM users WHERE LOWER(username) = ? AND chat_id = ?",
+                    user = await adb_query("SELECT user_id FROM users WHERE LOWER(username) = ? AND chat_id = ?",
                                     (mentioned_username, chat_id), fetchone=True)
                     if user:
                         return str(user['user_id'])
@@ -330,25 +1377,27 @@ async def get_target_id_from_message(message: types.Message, chat_id: int) -> st
 async def command_start_handler(message: types.Message) -> None:
     chat_id, user_id = message.chat.id, message.from_user.id
     first_name, username = message.from_user.first_name, message.from_user.username
-    lang = get_lang(chat_id)
-    user = db_query("SELECT 1 FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
+    lang = await get_lang(chat_id)
+    user = await adb_query("SELECT 1 FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
     if not user:
         initial_growth = random.randint(1, 10)
-        db_query(
+        await adb_query(
             "INSERT INTO users (chat_id, user_id, first_name, username, size, last_growth, status, medals) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
             (chat_id, user_id, first_name, username, initial_growth, datetime.now().isoformat(), 'normal', 0)
         )
+        leaderboard.set_size(chat_id, user_id, initial_growth)
         await message.answer(
             t('start_new', lang, first_name=html.escape(first_name), initial_growth=initial_growth)
         )
     else:
-        db_query("UPDATE users SET first_name = ?, username = ? WHERE user_id = ? AND chat_id = ?",
+        await adb_query("UPDATE users SET first_name = ?, username = ? WHERE user_id = ? AND chat_id = ?",
                  (first_name, username, user_id, chat_id))
+        forget_player_name(chat_id, user_id)
         await message.answer(t('start_existing', lang, first_name=html.escape(first_name)))
 
 @dp.message(Command("help"))
 async def command_help_handler(message: types.Message):
-    lang = get_lang(message.chat.id)
+    lang = await get_lang(message.chat.id)
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[[InlineKeyboardButton(text=t('help_button', lang), url=DOCS_URL)]])
     await message.answer(t('help_text', lang), reply_markup=keyboard, disable_web_page_preview=True)
@@ -362,8 +1411,8 @@ async def handle_humiliation(message: types.Message, user_data: dict):
 @dp.message(Command("grow"))
 async def command_grow_handler(message: types.Message):
     chat_id, user_id = message.chat.id, message.from_user.id
-    lang = get_lang(chat_id)
-    user_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
+    lang = await get_lang(chat_id)
+    user_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
     if not user_data:
         await message.answer(t('start_first', lang))
         return
@@ -390,20 +1439,22 @@ async def command_grow_handler(message: types.Message):
             growth = random.randint(1, 10)
 
     if growth == 0:
-        db_query("UPDATE users SET last_growth = ? WHERE user_id = ? AND chat_id = ?",
+        await adb_query("UPDATE users SET last_growth = ? WHERE user_id = ? AND chat_id = ?",
                  (datetime.now().isoformat(), user_id, chat_id))
         await message.answer(t('grow_fail', lang))
     else:
-        new_size = user_data.get("size", 0) + growth
-        db_query("UPDATE users SET size = ?, last_growth = ? WHERE user_id = ? AND chat_id = ?",
-                 (new_size, datetime.now().isoformat(), user_id, chat_id))
+        row = await adb_query("UPDATE users SET size = size + ?, last_growth = ? WHERE user_id = ? AND chat_id = ? RETURNING size",
+                              (growth, datetime.now().isoformat(), user_id, chat_id), fetchone=True)
+        new_size = row['size'] if row else user_data.get("size", 0) + growth
+        if row:
+            leaderboard.set_size(chat_id, user_id, new_size)
         await message.answer(t('grow_success', lang, growth=growth, new_size=new_size))
 
 @dp.message(Command("prestige"))
 async def command_prestige_handler(message: types.Message):
     chat_id, user_id = message.chat.id, message.from_user.id
-    lang = get_lang(chat_id)
-    user_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
+    lang = await get_lang(chat_id)
+    user_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
     if not user_data:
         await message.answer(t('start_first', lang))
         return
@@ -415,10 +1466,11 @@ async def command_prestige_handler(message: types.Message):
     if current_size >= PRESTIGE_REQUIREMENT:
         new_medals = user_data.get("medals", 0) + 1
         new_size = 5
-        db_query(
+        await adb_query(
             "UPDATE users SET size = ?, medals = medals + 1 WHERE user_id = ? AND chat_id = ?",
             (new_size, user_id, chat_id)
         )
+        leaderboard.set_size(chat_id, user_id, new_size)
         await message.answer(t('prestige_success', lang, req=PRESTIGE_REQUIREMENT, new_size=new_size, medals=new_medals))
     else:
         needed = PRESTIGE_REQUIREMENT - current_size
@@ -427,35 +1479,41 @@ async def command_prestige_handler(message: types.Message):
 @dp.message(Command("top"))
 async def command_top_handler(message: types.Message):
     chat_id = message.chat.id
-    lang = get_lang(chat_id)
-    sorted_users = db_query("SELECT * FROM users WHERE chat_id = ? ORDER BY size DESC LIMIT 15", (chat_id,),
-                            fetchall=True)
-    if not sorted_users:
+    lang = await get_lang(chat_id)
+    top_users = leaderboard.top(chat_id, 15)
+    if not top_users:
         await message.answer(t('top_no_players', lang))
         return
         
-    players = [await get_player_name(user['user_id'], chat_id) for user in sorted_users]
-    sizes = [user.get('size', 0) for user in sorted_users]
-    
-    plt.style.use('dark_background')
-    fig, ax = plt.subplots()
-    bars = ax.barh(players, sizes, color='#0088cc')
-    ax.invert_yaxis()
-    ax.set_xlabel(t('top_xlabel', lang))
-    ax.set_title(t('top_title', lang))
-    ax.bar_label(bars, fmt='%d см', label_type='edge', color='white', padding=5)
-    fig.tight_layout()
-    plt.savefig(CHART_FILE, dpi=200, bbox_inches='tight')
-    plt.close(fig)
-    chart = FSInputFile(CHART_FILE)
-    await message.answer_photo(chart, caption=t('top_caption', lang))
-    if os.path.exists(CHART_FILE): os.remove(CHART_FILE)
+    names = await get_player_names([user_id for user_id, _ in top_users], chat_id)
+    players = [names[user_id] for user_id, _ in top_users]
+    sizes = [size for _, size in top_users]
+
+    # Identical leaderboards produce identical images, so a chart already uploaded is resent by file_id.
+    chart_key = hashlib.sha256(json.dumps([lang, players, sizes]).encode()).hexdigest()
+    file_id = top_charts.get(chart_key)
+    if file_id:
+        try:
+            await message.answer_photo(file_id, caption=t('top_caption', lang))
+            return
+        except TelegramBadRequest as e:
+            logging.warning(f"Cached /top chart could not be resent, rendering again: {e}")
+            top_charts.pop(chart_key)
+
+    png = await render_chart(charts.render_top_chart, players, sizes, t('top_xlabel', lang), t('top_title', lang))
+    if png is None:
+        lines = [f"{place}. {player} — {size}" for place, (player, size) in enumerate(zip(players, sizes), start=1)]
+        await message.answer(f"<b>{t('top_title', lang)}</b>\n" + "\n".join(lines))
+        return
+    sent = await message.answer_photo(BufferedInputFile(png, filename="top.png"), caption=t('top_caption', lang))
+    if sent.photo:
+        top_charts.set(chart_key, sent.photo[-1].file_id)
 
 @dp.message(Command("nickname"))
 async def command_nickname_handler(message: types.Message, command: CommandObject):
     chat_id, user_id = message.chat.id, message.from_user.id
-    lang = get_lang(chat_id)
-    user_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
+    lang = await get_lang(chat_id)
+    user_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
     if not user_data:
         await message.answer(t('start_first', lang))
         return
@@ -465,7 +1523,8 @@ async def command_nickname_handler(message: types.Message, command: CommandObjec
         if len(new_nickname) > 20:
             await message.answer(t('nickname_too_long', lang))
             return
-        db_query("UPDATE users SET nickname = ? WHERE user_id = ? AND chat_id = ?", (new_nickname, user_id, chat_id))
+        await adb_query("UPDATE users SET nickname = ? WHERE user_id = ? AND chat_id = ?", (new_nickname, user_id, chat_id))
+        forget_player_name(chat_id, user_id)
         await message.answer(t('nickname_success', lang, nickname=html.escape(new_nickname)))
     else:
         await message.answer(t('nickname_prompt', lang))
@@ -473,14 +1532,15 @@ async def command_nickname_handler(message: types.Message, command: CommandObjec
 @dp.message(Command("me"))
 async def command_me_handler(message: types.Message):
     chat_id, user_id = message.chat.id, message.from_user.id
-    lang = get_lang(chat_id)
-    user_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
+    lang = await get_lang(chat_id)
+    user_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
     if not user_data:
         await message.answer(t('start_first', lang))
         return
         
-    all_users = db_query("SELECT * FROM users WHERE chat_id = ? ORDER BY size DESC", (chat_id,), fetchall=True)
-    rank = next((i + 1 for i, u in enumerate(all_users) if u['user_id'] == user_id), len(all_users))
+    # The row was just read, so it also refreshes this player's leaderboard entry.
+    leaderboard.set_size(chat_id, user_id, user_data.get('size', 0))
+    rank, total = leaderboard.rank(chat_id, user_id)
 
     response = f"{t('me_title', lang)}\n"
     if user_data.get('nickname'):
@@ -491,14 +1551,14 @@ async def command_me_handler(message: types.Message):
         response += f"{t('me_medals', lang, medals=medals)}\n"
 
     response += f"{t('me_size', lang, size=user_data.get('size', 0))}\n"
-    response += f"{t('me_rank', lang, rank=rank, total=len(all_users))}\n"
+    response += f"{t('me_rank', lang, rank=rank, total=total)}\n"
     if user_data.get('status') == 'condemned':
         response += t('me_status_condemned', lang)
     await message.answer(response)
 
 @dp.message(Command("language"))
 async def command_language_handler(message: types.Message):
-    lang = get_lang(message.chat.id)
+    lang = await get_lang(message.chat.id)
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Русский 🇷🇺", callback_data="set_lang:ru")],
         [InlineKeyboardButton(text="English 🇬🇧", callback_data="set_lang:en")]
@@ -509,34 +1569,36 @@ async def command_language_handler(message: types.Message):
 async def set_language_callback(callback: types.CallbackQuery):
     lang_code = callback.data.split(":")[1]
     chat_id = callback.message.chat.id
-    db_query(
+    await adb_query(
         "INSERT INTO chats (chat_id, language) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE SET language = excluded.language",
         (chat_id, lang_code)
     )
+    chat_languages[chat_id] = lang_code
     await callback.message.edit_text(t('lang_selected', lang_code))
     await callback.answer()
 
 @dp.message(Command("duel"))
+@serialized('duel')
 async def command_duel_handler(message: types.Message):
     chat_id, attacker_id = message.chat.id, message.from_user.id
-    attacker_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (attacker_id, chat_id),
+    attacker_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (attacker_id, chat_id),
                              fetchone=True)
     if not attacker_data: await message.answer("Сначала напиши /start"); return
     if await handle_humiliation(message, attacker_data): return
-    chat_info = db_query("SELECT active_duel_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
+    chat_info = await adb_query("SELECT active_duel_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
     if chat_info and chat_info.get("active_duel_json"): await message.answer(
         "В чате уже идет вызов на дуэль! Подождите."); return
     defender_id = await get_target_id_from_message(message, chat_id)
     if not defender_id: await message.answer("Цель не найдена. Ответь на сообщение или упомяни игрока через @."); return
     if str(attacker_id) == defender_id: await message.answer("Нельзя драться с самим собой."); return
-    defender_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (defender_id, chat_id),
+    defender_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (defender_id, chat_id),
                              fetchone=True)
     if not defender_data: await message.answer("Этот игрок еще не в игре."); return
     attacker_name = await get_player_name(attacker_id, chat_id)
     defender_name = await get_player_name(int(defender_id), chat_id)
     duel_data = {"attacker_id": attacker_id, "defender_id": int(defender_id),
                  "end_time": (datetime.now() + timedelta(seconds=DUEL_ACCEPT_TIMEOUT_SECONDS)).isoformat()}
-    db_query(
+    await adb_query(
         "INSERT INTO chats (chat_id, active_duel_json) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE SET active_duel_json = excluded.active_duel_json",
         (chat_id, json.dumps(duel_data)))
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -546,12 +1608,13 @@ async def command_duel_handler(message: types.Message):
         f"⚔️ <b>Вызов на дуэль!</b> ⚔️\n{attacker_name} бросает перчатку игроку {defender_name}!\nИсход решает удача (50/50). У тебя есть {DUEL_ACCEPT_TIMEOUT_SECONDS} секунд, чтобы принять вызов.",
         reply_markup=keyboard)
     duel_data['message_id'] = msg.message_id
-    db_query("UPDATE chats SET active_duel_json = ? WHERE chat_id = ?", (json.dumps(duel_data), chat_id))
+    await adb_query("UPDATE chats SET active_duel_json = ? WHERE chat_id = ?", (json.dumps(duel_data), chat_id))
+    scheduler.schedule((chat_id, 'duel'), datetime.fromisoformat(duel_data['end_time']), on_duel_timeout, chat_id)
 
 @dp.message(Command("casino"))
 async def command_casino_handler(message: types.Message, command: CommandObject):
     chat_id, user_id = message.chat.id, message.from_user.id
-    user_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
+    user_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
     if not user_data: await message.answer("Сначала напиши /start"); return
     if await handle_humiliation(message, user_data): return
     bet_str = command.args
@@ -561,61 +1624,67 @@ async def command_casino_handler(message: types.Message, command: CommandObject)
     if bet <= 0: await message.answer("Ставка должна быть больше нуля."); return
     if bet > current_size: await message.answer(
         f"Нельзя поставить больше, чем есть! Твой размер: {current_size} см."); return
+    # The bet is settled atomically right away (the size >= bet guard rejects concurrent bets that
+    # would overdraw); only the reveal of the outcome is delayed.
+    won = random.choice([True, False])
+    change = bet if won else -bet
+    row = await adb_query("UPDATE users SET size = size + ? WHERE user_id = ? AND chat_id = ? AND size >= ? RETURNING size",
+                          (change, user_id, chat_id, bet), fetchone=True, durable=True)
+    if not row:
+        size_row = await adb_query("SELECT size FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
+        current_size = size_row['size'] if size_row else 0
+        await message.answer(f"Нельзя поставить больше, чем есть! Твой размер: {current_size} см.")
+        return
+    leaderboard.set_size(chat_id, user_id, row['size'])
+    final_size = row['size']
     user_name = await get_player_name(user_id, chat_id)
     msg = await message.answer(f"<b>{user_name}</b> ставит {bet} см... 🎲")
-    await asyncio.sleep(3)
-
-    change = 0
-    if random.choice([True, False]):
-        change = bet
-        db_query("UPDATE users SET size = size + ? WHERE user_id = ? AND chat_id = ?", (change, user_id, chat_id))
-        final_size = current_size + change
-        await msg.edit_text(f"🎉 <b>ВЫИГРЫШ!</b> 🎉\nТы выиграл {bet} см! Твой новый размер: {final_size} см.")
+    if won:
+        result_text = f"🎉 <b>ВЫИГРЫШ!</b> 🎉\nТы выиграл {bet} см! Твой новый размер: {final_size} см."
     else:
-        change = -bet
-        db_query("UPDATE users SET size = size + ? WHERE user_id = ? AND chat_id = ?", (change, user_id, chat_id))
-        final_size = current_size + change
-        await msg.edit_text(f"😥 <b>ПРОИГРЫШ...</b> 😥\nТы потерял {bet} см! Твой новый размер: {final_size} см.")
+        result_text = f"😥 <b>ПРОИГРЫШ...</b> 😥\nТы потерял {bet} см! Твой новый размер: {final_size} см."
+    scheduler.call_later((chat_id, 'reveal', msg.message_id), CASINO_REVEAL_SECONDS,
+                         reveal_message, chat_id, msg.message_id, result_text)
 
 @dp.message(Command("tag"))
 async def command_tag_handler(message: types.Message):
     chat_id = message.chat.id
-    chat_info = db_query("SELECT last_tag_time FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True) or {}
+    chat_info = await adb_query("SELECT last_tag_time FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True) or {}
     last_tag_str = chat_info.get("last_tag_time")
     if last_tag_str:
         last_tag_time = datetime.fromisoformat(last_tag_str)
         if datetime.now() < last_tag_time + timedelta(seconds=TAG_COOLDOWN_SECONDS):
             await message.answer(f"Общий сбор можно будет объявить через несколько секунд.")
             return
-    all_users = db_query("SELECT user_id, first_name FROM users WHERE chat_id = ?", (chat_id,), fetchall=True)
+    all_users = await adb_query("SELECT user_id, first_name FROM users WHERE chat_id = ?", (chat_id,), fetchall=True)
     if not all_users: await message.answer("В этом чате еще нет игроков для сбора."); return
     mentions = [f"<a href='tg://user?id={user['user_id']}'>{html.escape(user.get('first_name', 'Player'))}</a>" for user in
                 all_users]
     await message.answer(f"📢 <b>ОБЩИЙ СБОР!</b> 📢\n{', '.join(mentions)}")
-    db_query(
+    await adb_query(
         "INSERT INTO chats (chat_id, last_tag_time) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE SET last_tag_time = excluded.last_tag_time",
         (chat_id, datetime.now().isoformat()))
 
 @dp.message(Command("trial"))
+@serialized('trial')
 async def command_trial_handler(message: types.Message):
     chat_id, prosecutor_id = message.chat.id, message.from_user.id
-    prosecutor_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (prosecutor_id, chat_id),
+    prosecutor_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (prosecutor_id, chat_id),
                                fetchone=True)
     if not prosecutor_data: await message.answer("Сначала напиши /start"); return
     if await handle_humiliation(message, prosecutor_data): return
-    chat_info = db_query("SELECT active_trial_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True) or {}
+    chat_info = await adb_query("SELECT active_trial_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True) or {}
     if chat_info.get("active_trial_json"): await message.answer("В чате уже идет суд!"); return
     defendant_id = await get_target_id_from_message(message, chat_id)
     if not defendant_id: await message.answer("Цель не найдена."); return
     if str(prosecutor_id) == defendant_id: await message.answer("Нельзя судить самого себя."); return
-    defendant_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (defendant_id, chat_id),
+    defendant_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (defendant_id, chat_id),
                               fetchone=True)
     if not defendant_data: await message.answer("Этот игрок еще не в игре"); return
     prosecutor_name = await get_player_name(prosecutor_id, chat_id)
     defendant_name = await get_player_name(int(defendant_id), chat_id)
     trial_data = {"prosecutor_id": prosecutor_id, "defendant_id": int(defendant_id),
-                  "end_time": (datetime.now() + timedelta(minutes=5)).isoformat(),
-                  "votes": {"guilty": [], "innocent": []}}
+                  "end_time": (datetime.now() + timedelta(minutes=5)).isoformat()}
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Виновен", callback_data="vote_guilty"),
                                                       InlineKeyboardButton(text="Невиновен",
                                                                            callback_data="vote_innocent")]])
@@ -623,25 +1692,27 @@ async def command_trial_handler(message: types.Message):
         f"⚖️ <b>СУД!</b> ⚖️\n{prosecutor_name} обвиняет {defendant_name}!\nГолосование длится 5 минут.",
         reply_markup=keyboard)
     trial_data['message_id'] = msg.message_id
-    db_query(
+    await adb_query(
         "INSERT INTO chats (chat_id, active_trial_json) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE SET active_trial_json = excluded.active_trial_json",
         (chat_id, json.dumps(trial_data)))
+    scheduler.schedule((chat_id, 'trial'), datetime.fromisoformat(trial_data['end_time']), on_trial_end, chat_id)
 
 @dp.message(Command("execute"))
 async def command_execute_handler(message: types.Message):
     chat_id, executioner_id = message.chat.id, message.from_user.id
     target_id = await get_target_id_from_message(message, chat_id)
     if not target_id: await message.answer("Цель для казни не найдена."); return
-    target_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (target_id, chat_id), fetchone=True)
-    executioner_data = db_query("SELECT first_name FROM users WHERE user_id = ? AND chat_id = ?",
+    target_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (target_id, chat_id), fetchone=True)
+    executioner_data = await adb_query("SELECT first_name FROM users WHERE user_id = ? AND chat_id = ?",
                                 (executioner_id, chat_id), fetchone=True)
     if not target_data or not executioner_data: return
     if target_data.get("status") == "condemned" and str(target_data.get("condemned_by")) == str(executioner_id):
         executioner_name = await get_player_name(executioner_id, chat_id)
         target_name = await get_player_name(int(target_id), chat_id)
-        db_query(
+        await adb_query(
             "UPDATE users SET size_before_execution = size, size = 0, status = 'executed', executed_at = ?, condemned_by = NULL, punishment_end_time = NULL WHERE user_id = ? AND chat_id = ?",
             (datetime.now().isoformat(), target_id, chat_id))
+        leaderboard.set_size(chat_id, target_id, 0)
         await message.answer(
             f"☠️ <b>ПРИГОВОР ИСПОЛНЕН!</b>\n{executioner_name} казнил {target_name}. Его вомбат обнулен.")
     else:
@@ -652,28 +1723,30 @@ async def command_pardon_handler(message: types.Message):
     chat_id = message.chat.id
     target_id = await get_target_id_from_message(message, chat_id)
     if not target_id: await message.answer("Цель для помилования не найдена."); return
-    target_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (target_id, chat_id), fetchone=True)
+    target_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (target_id, chat_id), fetchone=True)
     if not target_data: return
     if target_data.get("status") == "executed" and target_data.get("executed_at"):
         target_name = await get_player_name(int(target_id), chat_id)
         executed_at = datetime.fromisoformat(target_data["executed_at"])
         if datetime.now() < executed_at + timedelta(minutes=30):
-            db_query("UPDATE users SET size = ?, status = 'normal' WHERE user_id = ? AND chat_id = ?",
+            await adb_query("UPDATE users SET size = ?, status = 'normal' WHERE user_id = ? AND chat_id = ?",
                      (target_data['size_before_execution'], target_id, chat_id))
+            leaderboard.set_size(chat_id, target_id, target_data['size_before_execution'])
             await message.answer(
                 f"❤️ <b>МИЛОСЕРДИЕ!</b>\n{target_name} был помилован. Его вомбат восстановлен!")
         else:
             await message.answer("Слишком поздно для милосердия.")
 
 @dp.message(Command("blackjack"))
+@serialized('blackjack')
 async def command_blackjack_handler(message: types.Message, command: CommandObject):
     chat_id = message.chat.id
     user_id = message.from_user.id
-    lang = get_lang(chat_id)
+    lang = await get_lang(chat_id)
     user_name = await get_player_name(user_id, chat_id)
 
     game = get_blackjack_game(chat_id)
-    if game and game.get('state') not in [None, 'finished']:
+    if game and game.state not in [None, 'finished']:
         await message.answer(t('bj_already_running', lang))
         return
 
@@ -686,7 +1759,7 @@ async def command_blackjack_handler(message: types.Message, command: CommandObje
         await message.reply(t('bj_bet_positive', lang))
         return
 
-    user_data = db_query("SELECT size FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
+    user_data = await adb_query("SELECT size FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
     if not user_data:
         await message.answer(t('start_first', lang))
         return
@@ -697,20 +1770,8 @@ async def command_blackjack_handler(message: types.Message, command: CommandObje
 
     join_end_time = datetime.now() + timedelta(seconds=30)
 
-    new_game = {
-        "state": "waiting",
-        "host_id": user_id,
-        "players": {
-            str(user_id): {"hand": [], "bet": bet, "status": "playing"}
-        },
-        "deck": [],
-        "dealer_hand": [],
-        "message_id": None,
-        "current_player_index": 0,
-        "end_time": join_end_time.isoformat(),
-        "expecting_bet_from": None,
-        "turn_end_time": None,
-    }
+    new_game = BlackjackGame(user_id, join_end_time)
+    new_game.players[user_id] = BlackjackPlayer(bet)
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=t('bj_join_button', lang), callback_data="blackjack_join")]
@@ -721,19 +1782,21 @@ async def command_blackjack_handler(message: types.Message, command: CommandObje
     lobby_text = await generate_lobby_text(new_game, chat_id)
     msg = await message.answer(lobby_text, reply_markup=keyboard)
     
-    new_game['message_id'] = msg.message_id
+    new_game.message_id = msg.message_id
     save_blackjack_game(chat_id, new_game)
+    scheduler.schedule((chat_id, 'bj_lobby'), join_end_time, on_blackjack_lobby_end, chat_id)
 
 
 @dp.message(F.text & ~F.text.startswith('/'))
+@serialized('blackjack')
 async def handle_blackjack_bet(message: types.Message):
     chat_id = message.chat.id
     user_id = message.from_user.id
-    lang = get_lang(chat_id)
 
     game = get_blackjack_game(chat_id)
-    if not game or game.get('state') != 'waiting' or game.get('expecting_bet_from') != user_id:
+    if not game or game.state != 'waiting' or game.expecting_bet_from != user_id:
         return
+    lang = await get_lang(chat_id)
 
     bet_str = message.text
     if not bet_str.isdigit():
@@ -745,208 +1808,188 @@ async def handle_blackjack_bet(message: types.Message):
         await message.reply(t('bj_bet_positive', lang))
         return
 
-    user_data = db_query("SELECT size FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
+    user_data = await adb_query("SELECT size FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
     if not user_data or user_data['size'] < bet:
         await message.reply(t('bj_not_enough_size', lang, bet=bet, size=user_data.get('size', 0)))
-        game['expecting_bet_from'] = None 
+        game.expecting_bet_from = None 
         save_blackjack_game(chat_id, game)
         return
 
-    game['players'][str(user_id)] = {"hand": [], "bet": bet, "status": "playing"}
-    game['expecting_bet_from'] = None
+    game.players[user_id] = BlackjackPlayer(bet)
+    game.expecting_bet_from = None
     save_blackjack_game(chat_id, game)
     logging.info(f"[BJ_BET] Chat {chat_id}: User {user_id} successfully placed a bet of {bet}.")
 
-    try:
-        lobby_text = await generate_lobby_text(game, chat_id)
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=t('bj_join_button', lang), callback_data="blackjack_join")]
-        ])
-        await bot.edit_message_text(
-            text=lobby_text,
-            chat_id=chat_id,
-            message_id=game['message_id'],
-            reply_markup=keyboard
-        )
-    except TelegramBadRequest:
-        pass
+    lobby_text = await generate_lobby_text(game, chat_id)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=t('bj_join_button', lang), callback_data="blackjack_join")]
+    ])
+    edit_queue.edit(chat_id, game.message_id, lobby_text, keyboard)
     
     await message.reply(t('bj_bet_accepted', lang, bet=bet))
 
 async def start_blackjack_game_logic(chat_id: int):
     game = get_blackjack_game(chat_id)
-    lang = get_lang(chat_id)
-    if not game or game.get('state') != 'waiting':
-        logging.warning(f"[BJ_START_FAIL] Chat {chat_id}: Attempted to start game but state was not 'waiting'. State: {game.get('state') if game else 'None'}")
+    lang = await get_lang(chat_id)
+    if not game or game.state != 'waiting':
+        logging.warning(f"[BJ_START_FAIL] Chat {chat_id}: Attempted to start game but state was not 'waiting'. State: {game.state if game else 'None'}")
         return
 
-    if not game['players']:
+    if not game.players:
         logging.info(f"[BJ_CANCEL] Chat {chat_id}: No players joined. Cancelling game.")
-        try:
-            await bot.edit_message_text(
-                text=t('bj_no_players_cancel', lang),
-                chat_id=chat_id,
-                message_id=game['message_id'],
-                reply_markup=None
-            )
-        except TelegramBadRequest:
-            pass
         save_blackjack_game(chat_id, None)
+        edit_queue.edit(chat_id, game.message_id, t('bj_no_players_cancel', lang))
         return
     
-    logging.info(f"[BJ_STARTING] Chat {chat_id}: Starting blackjack game with players: {list(game['players'].keys())}")
-    game['state'] = 'in_progress'
+    logging.info(f"[BJ_STARTING] Chat {chat_id}: Starting blackjack game with players: {game.player_ids}")
+    game.state = 'in_progress'
     deck = create_deck()
     random.shuffle(deck)
-    game['deck'] = deck
+    game.deck = deck
 
-    for player_id_str in game['players']:
-        player_data = game['players'][player_id_str]
-        player_data['hand'].append(game['deck'].pop())
-        player_data['hand'].append(game['deck'].pop())
+    for player in game.players.values():
+        player.hand.append(game.deck.pop())
+        player.hand.append(game.deck.pop())
 
-    game['dealer_hand'].append(game['deck'].pop())
-    game['dealer_hand'].append(game['deck'].pop())
+    game.dealer_hand.append(game.deck.pop())
+    game.dealer_hand.append(game.deck.pop())
+    save_blackjack_game(chat_id, game)
 
-    try:
-        player_names = [await get_player_name(int(uid), chat_id) for uid in game['players']]
-        await bot.edit_message_text(
-            text=t('bj_game_started', lang, players=', '.join(player_names)),
-            chat_id=chat_id,
-            message_id=game['message_id'],
-            reply_markup=None
-        )
-    except TelegramBadRequest:
-        pass
+    player_names = list((await get_player_names(game.players, chat_id)).values())
+    edit_queue.edit(chat_id, game.message_id, t('bj_game_started', lang, players=', '.join(player_names)))
 
-    await asyncio.sleep(2)
-    
-    game['turn_end_time'] = (datetime.now() + timedelta(seconds=BLACKJACK_TURN_SECONDS)).isoformat()
-    save_blackjack_game(chat_id, game)
-    await update_blackjack_message(chat_id)
+    scheduler.call_later((chat_id, 'bj_step'), BLACKJACK_DEAL_SECONDS, resume_blackjack, chat_id, process_next_player_turn)
 
 async def update_blackjack_message(chat_id: int, game_over: bool = False):
     game = get_blackjack_game(chat_id)
     if not game: return
-    lang = get_lang(chat_id)
+    lang = await get_lang(chat_id)
 
     dealer_status = ""
-    dealer_hand_value = get_hand_value(game['dealer_hand'])
-    if game_over or game['state'] == 'dealer_turn':
+    dealer_hand_value = game.dealer_hand.value
+    if game_over or game.state == 'dealer_turn':
         if dealer_hand_value > 21:
             dealer_status = " (Перебор!)"
-        dealer_hand_str = format_hand(game['dealer_hand'])
+        dealer_hand_str = format_hand(game.dealer_hand)
         dealer_value_str = f"({dealer_hand_value}){dealer_status}"
     else:
-        dealer_hand_str = f"{format_hand([game['dealer_hand'][0]])} [?]"
-        dealer_value_str = f"({get_card_value(game['dealer_hand'][0])})"
+        dealer_hand_str = f"{format_hand([game.dealer_hand[0]])} [?]"
+        dealer_value_str = f"({get_card_value(game.dealer_hand[0])})"
 
     text = f"🤵‍♂️ <b>Дилер:</b> {dealer_hand_str} {dealer_value_str}\n"
     text += "------------------------------------\n"
     
-    player_ids = list(game['players'].keys())
+    names = await get_player_names(game.players, chat_id)
     
-    for i, player_id_str in enumerate(player_ids):
-        player_id = int(player_id_str)
-        player_data = game['players'][player_id_str]
-        player_name = await get_player_name(player_id, chat_id)
-        hand_str = format_hand(player_data['hand'])
-        hand_value = get_hand_value(player_data['hand'])
+    for i, (player_id, player) in enumerate(game.players.items()):
+        player_name = names[player_id]
+        hand_str = format_hand(player.hand)
+        hand_value = player.hand.value
         
         status_emoji = ""
-        if player_data['status'] == 'busted' or hand_value > 21:
+        if player.status == 'busted' or hand_value > 21:
             status_emoji = "💥"
-        elif player_data['status'] == 'stood':
+        elif player.status == 'stood':
             status_emoji = "✋"
         
-        cursor = "▶️ " if i == game['current_player_index'] and not game_over and game['state'] == 'in_progress' else "👤 "
+        cursor = "▶️ " if i == game.current_player_index and not game_over and game.state == 'in_progress' else "👤 "
         text += f"{cursor}<b>{player_name}:</b> {hand_str} ({hand_value}) {status_emoji}\n"
 
     keyboard = None
-    if not game_over and game['state'] == 'in_progress':
+    if not game_over and game.state == 'in_progress':
         text += "\n"
-        if game['current_player_index'] < len(player_ids):
-            current_player_id = int(player_ids[game['current_player_index']])
-            current_player_name = await get_player_name(current_player_id, chat_id)
+        current_player_id = game.current_player_id()
+        if current_player_id is not None:
+            current_player_name = names[current_player_id]
             text += t('bj_turn_of', lang, name=current_player_name)
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text=t('bj_hit_button', lang), callback_data="blackjack_hit"),
                  InlineKeyboardButton(text=t('bj_stand_button', lang), callback_data="blackjack_stand")]
             ])
 
-    try:
-        await bot.edit_message_text(
-            text=text,
-            chat_id=chat_id,
-            message_id=game['message_id'],
-            reply_markup=keyboard
-        )
-    except TelegramBadRequest as e:
-        logging.warning(f"Failed to edit blackjack message in chat {chat_id}, content might be unchanged. Error: {e}")
+    edit_queue.edit(chat_id, game.message_id, text, keyboard)
 
 async def process_next_player_turn(chat_id):
     game = get_blackjack_game(chat_id)
-    if not game: return
+    if not game or game.state != 'in_progress': return
 
-    player_ids = list(game['players'].keys())
+    player_ids = game.player_ids
     
-    while game['current_player_index'] < len(player_ids):
-        current_player_id_str = player_ids[game['current_player_index']]
-        if get_hand_value(game['players'][current_player_id_str]['hand']) > 21:
-            game['players'][current_player_id_str]['status'] = 'busted'
-            game['current_player_index'] += 1
+    while game.current_player_index < len(player_ids):
+        player = game.players[player_ids[game.current_player_index]]
+        if player.hand.value > 21:
+            player.status = 'busted'
+            game.current_player_index += 1
         else:
             break 
 
-    if game['current_player_index'] >= len(player_ids):
-        game['turn_end_time'] = None
-        save_blackjack_game(chat_id, game)
+    if game.current_player_index >= len(player_ids):
+        game.turn_end_time = None
         await dealer_turn(chat_id)
     else:
-        game['turn_end_time'] = (datetime.now() + timedelta(seconds=BLACKJACK_TURN_SECONDS)).isoformat()
+        start_blackjack_turn_clock(chat_id, game)
         save_blackjack_game(chat_id, game)
         await update_blackjack_message(chat_id)
 
 async def dealer_turn(chat_id):
     game = get_blackjack_game(chat_id)
     if not game: return
-    lang = get_lang(chat_id)
+    lang = await get_lang(chat_id)
     
-    game['state'] = 'dealer_turn'
+    game.state = 'dealer_turn'
     save_blackjack_game(chat_id, game)
     await update_blackjack_message(chat_id)
     await bot.send_message(chat_id, t('bj_dealer_turn', lang))
-    await asyncio.sleep(2)
+    scheduler.call_later((chat_id, 'bj_step'), BLACKJACK_DEALER_FIRST_CARD_SECONDS, resume_blackjack, chat_id, dealer_step)
 
-    while get_hand_value(game['dealer_hand']) < 17:
-        game['dealer_hand'].append(game['deck'].pop())
+@serialized('blackjack')
+async def resume_blackjack(chat_id, step):
+    # Entry point for scheduled blackjack continuations.
+    await step(chat_id)
+
+async def dealer_step(chat_id):
+    # One dealer draw per call; the pause between cards is a scheduled continuation, not a sleep.
+    game = get_blackjack_game(chat_id)
+    if not game or game.state != 'dealer_turn': return
+
+    if game.dealer_hand.value < 17:
+        game.dealer_hand.append(game.deck.pop())
         save_blackjack_game(chat_id, game)
         await update_blackjack_message(chat_id)
-        await asyncio.sleep(1.5)
-    
-    await end_blackjack_game(chat_id)
+        scheduler.call_later((chat_id, 'bj_step'), BLACKJACK_DEALER_CARD_SECONDS, resume_blackjack, chat_id, dealer_step)
+    else:
+        await end_blackjack_game(chat_id)
 
 async def end_blackjack_game(chat_id):
     game = get_blackjack_game(chat_id)
     if not game: return
-    lang = get_lang(chat_id)
+    lang = await get_lang(chat_id)
+    # Detach the game first so nothing else can act on it while results are settled.
+    save_blackjack_game(chat_id, None)
+    scheduler.cancel((chat_id, 'bj_turn'))
+    scheduler.cancel((chat_id, 'bj_step'))
     
     logging.info(f"[BJ_END] Chat {chat_id}: Blackjack game ended. Calculating results.")
     
-    initial_sizes = {}
     results_data = []
 
-    dealer_value = get_hand_value(game['dealer_hand'])
+    dealer_value = game.dealer_hand.value
     dealer_busts = dealer_value > 21
 
-    for player_id_str, player_data in game['players'].items():
-        player_id = int(player_id_str)
-        user_info = db_query("SELECT size FROM users WHERE user_id=? AND chat_id=?", (player_id, chat_id), fetchone=True)
-        initial_sizes[player_id_str] = user_info['size'] if user_info else 0
-        
-        player_name = await get_player_name(player_id, chat_id)
-        player_value = get_hand_value(player_data['hand'])
-        bet = player_data['bet']
+    player_ids = game.player_ids
+    placeholders = ", ".join("?" * len(player_ids))
+    rows = await adb_query(
+        f"SELECT user_id, size, first_name, nickname FROM users WHERE chat_id = ? AND user_id IN ({placeholders})",
+        (chat_id, *player_ids), fetchall=True)
+    for row in rows:
+        remember_player_name(chat_id, row)
+    initial_sizes = {row['user_id']: row['size'] for row in rows}
+    names = await get_player_names(player_ids, chat_id)
+
+    for player_id, player in game.players.items():
+        player_name = names[player_id]
+        player_value = player.hand.value
+        bet = player.bet
         change = 0
         
         result_text = ""
@@ -969,77 +2012,62 @@ async def end_blackjack_game(chat_id):
             color = 'yellow'
         
         if change != 0:
-            db_query("UPDATE users SET size = size + ? WHERE user_id = ? AND chat_id = ?", (change, player_id, chat_id))
-            db_query("UPDATE users SET size = 0 WHERE user_id = ? AND chat_id = ? AND size < 0", (player_id, chat_id))
+            row = await adb_query("UPDATE users SET size = max(0, size + ?) WHERE user_id = ? AND chat_id = ? RETURNING size",
+                                  (change, player_id, chat_id), fetchone=True, durable=True)
+            if row:
+                leaderboard.set_size(chat_id, player_id, row['size'])
 
-        new_size = initial_sizes.get(player_id_str, 0) + change
+        new_size = initial_sizes.get(player_id, 0) + change
         results_data.append({
             "name": player_name,
-            "hand": format_hand(player_data['hand']),
+            "cards": [CARD_LABELS[card] for card in player.hand],
             "value": player_value,
             "result_text": result_text,
             "color": color,
-            "balance_text": f"{initial_sizes.get(player_id_str, 0)} → {new_size} см"
+            "balance_text": f"{initial_sizes.get(player_id, 0)} → {new_size} см"
         })
 
-    # --- Image Generation ---
-    plt.style.use('dark_background')
-    fig, ax = plt.subplots(figsize=(8, 4 + len(results_data) * 1.5))
-    fig.patch.set_facecolor('#1c1c1c')
-    ax.set_facecolor('#1c1c1c')
-
-    ax.set_title(t('bj_results_title', lang), fontsize=20, color='white', pad=20)
-    ax.axis('off')
-
-    dealer_hand_str = format_hand(game['dealer_hand'])
-    dealer_status = " (Перебор!)" if dealer_busts else ""
-    ax.text(0.5, 0.9, f"{t('bj_dealer_hand', lang)}: {dealer_hand_str} ({dealer_value}){dealer_status}", ha='center', va='center', fontsize=14, color='cyan')
-
-    y_pos = 0.8
-    for data in results_data:
-        ax.text(0.05, y_pos, data['name'], ha='left', va='center', fontsize=14, color='white', weight='bold')
-        ax.text(0.05, y_pos - 0.05, f"{t('bj_player_hand', lang)}: {data['hand']} ({data['value']})", ha='left', va='center', fontsize=12, color='lightgrey')
-        ax.text(0.95, y_pos, data['result_text'], ha='right', va='center', fontsize=14, color=data['color'], weight='bold')
-        ax.text(0.95, y_pos - 0.05, f"{t('bj_player_balance', lang)}: {data['balance_text']}", ha='right', va='center', fontsize=12, color='lightgrey')
-        y_pos -= 0.15
-
-    fig.tight_layout(pad=2.0)
-    plt.savefig(BJ_RESULTS_FILE, dpi=150, bbox_inches='tight', facecolor=fig.get_facecolor())
-    plt.close(fig)
-
-    photo = FSInputFile(BJ_RESULTS_FILE)
-    await bot.send_photo(chat_id, photo, reply_to_message_id=game['message_id'])
-    if os.path.exists(BJ_RESULTS_FILE):
-        os.remove(BJ_RESULTS_FILE)
-        
-    save_blackjack_game(chat_id, None)
+    dealer = {"label": t('bj_dealer_hand', lang), "cards": [CARD_LABELS[card] for card in game.dealer_hand],
+              "value": dealer_value, "status": " (Перебор!)" if dealer_busts else ""}
+    png = await render_chart(charts.render_blackjack_results, t('bj_results_title', lang), dealer, results_data,
+                             t('bj_player_hand', lang), t('bj_player_balance', lang))
+    if png is None:
+        dealer_line = f"{dealer['label']}: {format_hand(game.dealer_hand)} ({dealer_value}){dealer['status']}"
+        lines = [f"<b>{data['name']}</b>: {' '.join(data['cards'])} ({data['value']}) — {data['result_text']} "
+                 f"{t('bj_player_balance', lang)}: {data['balance_text']}" for data in results_data]
+        await bot.send_message(chat_id, f"<b>{t('bj_results_title', lang)}</b>\n{dealer_line}\n\n" + "\n".join(lines),
+                               reply_to_message_id=game.message_id)
+        return
+    await bot.send_photo(chat_id, BufferedInputFile(png, filename="blackjack_results.jpg"),
+                         reply_to_message_id=game.message_id)
 
 
 @dp.callback_query(F.data == "blackjack_join")
+@serialized('blackjack')
 async def process_blackjack_join_callback(callback: types.CallbackQuery):
     chat_id = callback.message.chat.id
     user_id = callback.from_user.id
-    lang = get_lang(chat_id)
+    lang = await get_lang(chat_id)
     
     game = get_blackjack_game(chat_id)
-    if not game or game['state'] != 'waiting':
+    if not game or game.state != 'waiting':
         await callback.answer(t('bj_already_running', lang), show_alert=True)
         return
 
-    if str(user_id) in game['players']:
+    if user_id in game.players:
         await callback.answer("Ты уже в игре!", show_alert=True)
         return
 
-    if game.get('expecting_bet_from') is not None:
+    if game.expecting_bet_from is not None:
         await callback.answer("Подождите, пока другой игрок сделает свою ставку.", show_alert=True)
         return
     
-    user_data = db_query("SELECT size FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
+    user_data = await adb_query("SELECT size FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id), fetchone=True)
     if not user_data:
         await callback.answer(t('start_first', lang), show_alert=True)
         return
 
-    game['expecting_bet_from'] = user_id
+    game.expecting_bet_from = user_id
     save_blackjack_game(chat_id, game)
     
     logging.info(f"[BJ_JOIN] Chat {chat_id}: User {user_id} clicked join. Prompting for bet.")
@@ -1049,6 +2077,7 @@ async def process_blackjack_join_callback(callback: types.CallbackQuery):
 
 
 @dp.callback_query(F.data.startswith("blackjack_"))
+@serialized('blackjack')
 async def process_blackjack_callback(callback: types.CallbackQuery):
     if callback.data == "blackjack_join":
         return 
@@ -1057,88 +2086,83 @@ async def process_blackjack_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
     game = get_blackjack_game(chat_id)
-    if not game or game['state'] != 'in_progress':
+    if not game or game.state != 'in_progress':
         await callback.answer("Игра неактивна.", show_alert=True)
         return
 
-    player_ids = list(game['players'].keys())
-    if game['current_player_index'] >= len(player_ids):
-        await callback.answer("Сейчас не ваш ход!", show_alert=True)
-        return
-        
-    current_player_id = int(player_ids[game['current_player_index']])
-
-    if user_id != current_player_id:
+    if user_id != game.current_player_id():
         await callback.answer("Сейчас не ваш ход!", show_alert=True)
         return
 
     action = callback.data.split("_")[1]
     logging.info(f"[BJ_ACTION] Chat {chat_id}: Player {user_id} chose to {action}.")
     
-    game['turn_end_time'] = None # Stop the timer
+    game.turn_end_time = None # Stop the timer
+    scheduler.cancel((chat_id, 'bj_turn'))
+    player = game.players[user_id]
 
     if action == "hit":
-        game['players'][str(user_id)]['hand'].append(game['deck'].pop())
+        player.hand.append(game.deck.pop())
         
-        if get_hand_value(game['players'][str(user_id)]['hand']) >= 21:
-            game['current_player_index'] += 1
+        if player.hand.value >= 21:
+            game.current_player_index += 1
             save_blackjack_game(chat_id, game)
             await update_blackjack_message(chat_id)
-            await asyncio.sleep(1)
-            await process_next_player_turn(chat_id)
+            scheduler.call_later((chat_id, 'bj_step'), BLACKJACK_NEXT_TURN_SECONDS, resume_blackjack, chat_id, process_next_player_turn)
         else:
-            game['turn_end_time'] = (datetime.now() + timedelta(seconds=BLACKJACK_TURN_SECONDS)).isoformat()
+            start_blackjack_turn_clock(chat_id, game)
             save_blackjack_game(chat_id, game)
             await update_blackjack_message(chat_id)
 
     elif action == "stand":
-        game['players'][str(user_id)]['status'] = 'stood'
-        game['current_player_index'] += 1
-        save_blackjack_game(chat_id, game)
+        player.status = 'stood'
+        game.current_player_index += 1
         await process_next_player_turn(chat_id)
     
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("vote_"))
+@serialized('trial')
 async def process_vote_callback(callback: types.CallbackQuery):
     chat_id, user_id = callback.message.chat.id, callback.from_user.id
-    chat_info = db_query("SELECT active_trial_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
+    chat_info = await adb_query("SELECT active_trial_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
     if not chat_info or not chat_info['active_trial_json']: await callback.answer("Голосование завершено.",
                                                                                  show_alert=True); return
     trial = json.loads(chat_info['active_trial_json'])
     if str(user_id) in [str(trial["prosecutor_id"]), str(trial["defendant_id"])]: await callback.answer(
         "Обвинитель и обвиняемый не голосуют.", show_alert=True); return
-    if any(user_id in v for v in trial["votes"].values()): await callback.answer("Вы уже проголосовали.",
-                                                                                 show_alert=True); return
     vote = callback.data.split("_")[1]
-    trial["votes"][vote].append(user_id)
-    db_query("UPDATE chats SET active_trial_json = ? WHERE chat_id = ?", (json.dumps(trial), chat_id))
+    tally = await get_trial_tally(chat_id, trial["message_id"])
+    inserted = await adb_query(
+        "INSERT OR IGNORE INTO trial_votes (chat_id, trial_id, user_id, vote) VALUES (?, ?, ?, ?) RETURNING vote",
+        (chat_id, trial["message_id"], user_id, vote), fetchone=True)
+    if not inserted: await callback.answer("Вы уже проголосовали.", show_alert=True); return
+    tally[vote] += 1
     await callback.answer(f"Ваш голос '{vote}' принят!")
-    guilty_count, innocent_count = len(trial["votes"]["guilty"]), len(trial["votes"]["innocent"])
+    guilty_count, innocent_count = tally["guilty"], tally["innocent"]
     defendant_name = await get_player_name(trial['defendant_id'], chat_id)
     prosecutor_name = await get_player_name(trial['prosecutor_id'], chat_id)
-    await bot.edit_message_text(
-        text=(
-            f"⚖️ <b>СУД!</b> ⚖️\n{prosecutor_name} обвиняет {defendant_name}!\n"
-            f"Голосование длится 5 минут.\n\n"
-            f"<b>Голоса 'Виновен': {guilty_count} | 'Невиновен': {innocent_count}</b>"
-        ),
-        chat_id=chat_id,
-        message_id=trial["message_id"],
-        reply_markup=callback.message.reply_markup
+    edit_queue.edit(
+        chat_id, trial["message_id"],
+        f"⚖️ <b>СУД!</b> ⚖️\n{prosecutor_name} обвиняет {defendant_name}!\n"
+        f"Голосование длится 5 минут.\n\n"
+        f"<b>Голоса 'Виновен': {guilty_count} | 'Невиновен': {innocent_count}</b>",
+        callback.message.reply_markup
     )
 
 @dp.callback_query(F.data.startswith("set_term:"))
 async def set_term_callback(callback: types.CallbackQuery):
     chat_id, prosecutor_id = callback.message.chat.id, callback.from_user.id
     _, defendant_id, hours = callback.data.split(":")
-    defendant_data = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (defendant_id, chat_id),
+    defendant_data = await adb_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (defendant_id, chat_id),
                               fetchone=True)
     if not defendant_data or str(prosecutor_id) != str(defendant_data.get("condemned_by")): await callback.answer(
         "Только обвинитель может выбрать срок.", show_alert=True); return
     end_time = (datetime.now() + timedelta(hours=int(hours))).isoformat()
-    db_query("UPDATE users SET punishment_end_time = ? WHERE user_id = ? AND chat_id = ?",
+    await adb_query("UPDATE users SET punishment_end_time = ? WHERE user_id = ? AND chat_id = ?",
              (end_time, defendant_id, chat_id))
+    scheduler.schedule((chat_id, 'punishment', int(defendant_id)), datetime.fromisoformat(end_time),
+                       on_punishment_end, chat_id, int(defendant_id))
     days, hours_rem = divmod(int(hours), 24)
     defendant_name = await get_player_name(int(defendant_id), chat_id)
     await callback.message.edit_text(
@@ -1146,134 +2170,424 @@ async def set_term_callback(callback: types.CallbackQuery):
     )
 
 @dp.callback_query(F.data.startswith("duel_"))
+@serialized('duel')
 async def process_duel_callback(callback: types.CallbackQuery):
     chat_id, user_id = callback.message.chat.id, callback.from_user.id
-    chat_info = db_query("SELECT active_duel_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
+    chat_info = await adb_query("SELECT active_duel_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
     if not chat_info or not chat_info['active_duel_json']:
+        edit_queue.discard(chat_id, callback.message.message_id)
         await callback.message.edit_text(text="Этот вызов на дуэль уже недействителен.")
         return
     duel_data = json.loads(chat_info['active_duel_json'])
     if user_id != duel_data["defender_id"]: await callback.answer("Это не твой вызов!", show_alert=True); return
+    # Claim the duel atomically so a double click (or the timeout) cannot resolve it twice.
+    claimed = await adb_query("UPDATE chats SET active_duel_json = NULL WHERE chat_id = ? AND active_duel_json = ? RETURNING chat_id",
+                              (chat_id, chat_info['active_duel_json']), fetchone=True)
+    if not claimed:
+        await callback.answer("Этот вызов на дуэль уже недействителен.", show_alert=True)
+        return
+    scheduler.cancel((chat_id, 'duel'))
+    edit_queue.discard(chat_id, callback.message.message_id)
     action = callback.data.split("_")[1]
     attacker_id, defender_id = duel_data["attacker_id"], duel_data["defender_id"]
-    attacker = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (attacker_id, chat_id), fetchone=True)
-    defender = db_query("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", (defender_id, chat_id), fetchone=True)
     
-    attacker_name = await get_player_name(attacker_id, chat_id)
-    defender_name = await get_player_name(defender_id, chat_id)
+    names = await get_player_names([attacker_id, defender_id], chat_id)
+    attacker_name, defender_name = names[attacker_id], names[defender_id]
 
     if action == "decline":
         await callback.message.edit_text(
             text=f"{defender_name} трусливо отказался от дуэли с {attacker_name}.")
     elif action == "accept":
-        await callback.message.edit_text(text=f"{defender_name} принимает вызов! Бой начинается...")
-        await asyncio.sleep(2)
         winner_id, loser_id = random.sample([attacker_id, defender_id], 2)
-        winner_name = await get_player_name(winner_id, chat_id)
-        loser_name = await get_player_name(loser_id, chat_id)
-        loser_size = db_query("SELECT size FROM users WHERE user_id = ? AND chat_id = ?", (loser_id, chat_id), fetchone=True)['size']
-        
-        stolen_size = random.randint(1, 5)
-        final_loser_size = max(0, loser_size - stolen_size)
-        stolen_size = loser_size - final_loser_size
-        
-        db_query("UPDATE users SET size = size + ? WHERE user_id = ? AND chat_id = ?",
-                 (stolen_size, winner_id, chat_id))
-        db_query("UPDATE users SET size = ? WHERE user_id = ? AND chat_id = ?",
-                 (final_loser_size, loser_id, chat_id))
-        await callback.message.edit_text(
-            text=f"🏆 <b>Победитель: {winner_name}!</b>\nВ случайной схватке удача была на его стороне. Он отбирает у {loser_name} целых {stolen_size} см!")
-    db_query("UPDATE chats SET active_duel_json = NULL WHERE chat_id = ?", (chat_id,))
+        stolen_size, winner_size, loser_size = await adb_transaction(
+            functools.partial(_duel_transfer, chat_id=chat_id, winner_id=winner_id, loser_id=loser_id,
+                              amount=random.randint(1, 5)), durable=True)
+        if winner_size is not None:
+            leaderboard.set_size(chat_id, winner_id, winner_size)
+        leaderboard.set_size(chat_id, loser_id, loser_size)
+        await callback.message.edit_text(text=f"{defender_name} принимает вызов! Бой начинается...")
+        scheduler.call_later(
+            (chat_id, 'reveal', callback.message.message_id), DUEL_REVEAL_SECONDS, reveal_message, chat_id,
+            callback.message.message_id,
+            f"🏆 <b>Победитель: {names[winner_id]}!</b>\nВ случайной схватке удача была на его стороне. Он отбирает у {names[loser_id]} целых {stolen_size} см!")
+
+def _duel_transfer(conn, chat_id, winner_id, loser_id, amount):
+    # Runs on the writer thread: the loser's size is read and both sizes written in one transaction.
+    row = _execute(conn, "SELECT size FROM users WHERE user_id = ? AND chat_id = ?", (loser_id, chat_id), fetchone=True)
+    loser_size = row['size'] if row else 0
+    stolen_size = min(amount, loser_size)
+    winner = _execute(conn, "UPDATE users SET size = size + ? WHERE user_id = ? AND chat_id = ? RETURNING size",
+                      (stolen_size, winner_id, chat_id), fetchone=True)
+    _execute(conn, "UPDATE users SET size = ? WHERE user_id = ? AND chat_id = ?", (loser_size - stolen_size, loser_id, chat_id))
+    return stolen_size, winner['size'] if winner else None, loser_size - stolen_size
+
+# --- Timer Callbacks ---
+# Each callback re-reads the current state and re-checks its deadline, so a timer that outlived
+# the state it was armed for (a finished game, an answered duel) is a harmless no-op.
+def deadline_passed(end_time: datetime | str | None) -> bool:
+    if isinstance(end_time, str):
+        end_time = datetime.fromisoformat(end_time)
+    return end_time is not None and datetime.now() >= end_time
+
+async def reveal_message(chat_id: int, message_id: int, text: str):
+    edit_queue.edit(chat_id, message_id, text)
+
+@serialized('duel')
+async def on_duel_timeout(chat_id: int):
+    chat_info = await adb_query("SELECT active_duel_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
+    if not chat_info or not chat_info['active_duel_json']:
+        return
+    duel = json.loads(chat_info['active_duel_json'])
+    if not deadline_passed(duel["end_time"]):
+        scheduler.schedule((chat_id, 'duel'), datetime.fromisoformat(duel["end_time"]), on_duel_timeout, chat_id)
+        return
+    await adb_query("UPDATE chats SET active_duel_json = NULL WHERE chat_id = ?", (chat_id,))
+    if duel.get("message_id"):
+        edit_queue.edit(chat_id, duel["message_id"], "Время вышло! Вызов на дуэль отменен.")
 
-async def background_tasks():
-    while True:
-        await asyncio.sleep(5)
-        now = datetime.now()
+@serialized('blackjack')
+async def on_blackjack_lobby_end(chat_id: int):
+    game = get_blackjack_game(chat_id)
+    if not game or game.state != 'waiting':
+        return
+    if not deadline_passed(game.end_time):
+        scheduler.schedule((chat_id, 'bj_lobby'), game.end_time, on_blackjack_lobby_end, chat_id)
+        return
+    logging.info(f"[BJ_TIMER_EXPIRED] Chat {chat_id}: Lobby timer expired. Forcing game start.")
+    if game.expecting_bet_from is not None:
+        logging.warning(f"[BJ_BET_TIMEOUT] Chat {chat_id}: User {game.expecting_bet_from} did not bet in time.")
+        game.expecting_bet_from = None
+    await start_blackjack_game_logic(chat_id)
+
+@serialized('blackjack')
+async def on_blackjack_turn_timeout(chat_id: int):
+    game = get_blackjack_game(chat_id)
+    if not game or game.state != 'in_progress' or not game.turn_end_time:
+        return
+    if not deadline_passed(game.turn_end_time):
+        arm_blackjack_turn_timer(chat_id, game)
+        return
+    lang = await get_lang(chat_id)
+    current_player_id = game.current_player_id()
+    current_player_name = await get_player_name(current_player_id, chat_id)
+
+    logging.warning(f"[BJ_TURN_TIMEOUT] Chat {chat_id}: Player {current_player_id} timed out.")
+
+    game.players[current_player_id].status = 'stood'
+    game.current_player_index += 1
+    game.turn_end_time = None
+    save_blackjack_game(chat_id, game)
+
+    await bot.send_message(chat_id, t('bj_turn_timeout', lang, name=current_player_name))
+    await process_next_player_turn(chat_id)
+
+@serialized('trial')
+async def on_trial_end(chat_id: int):
+    chat_info = await adb_query("SELECT active_trial_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
+    if not chat_info or not chat_info['active_trial_json']:
+        return
+    trial = json.loads(chat_info['active_trial_json'])
+    if not deadline_passed(trial["end_time"]):
+        scheduler.schedule((chat_id, 'trial'), datetime.fromisoformat(trial["end_time"]), on_trial_end, chat_id)
+        return
+    prosecutor_id, defendant_id = trial["prosecutor_id"], trial["defendant_id"]
+    prosecutor_name = await get_player_name(prosecutor_id, chat_id)
+    defendant_name = await get_player_name(defendant_id, chat_id)
+    votes = await count_trial_votes(chat_id, trial["message_id"])
+    guilty_count, innocent_count = votes["guilty"], votes["innocent"]
+    trial_tallies.pop((chat_id, trial["message_id"]), None)
+    await adb_query("UPDATE chats SET active_trial_json = NULL WHERE chat_id = ?", (chat_id,))
+    await adb_query("DELETE FROM trial_votes WHERE chat_id = ? AND trial_id = ?", (chat_id, trial["message_id"]), wait=False)
+    # The trial message is deleted below; a vote count still waiting in the edit queue must not follow.
+    edit_queue.discard(chat_id, trial["message_id"])
+    if guilty_count > innocent_count and (guilty_count + innocent_count) >= 1:
+        await adb_query("UPDATE users SET status='condemned', condemned_by=? WHERE user_id=? AND chat_id=?", (prosecutor_id, defendant_id, chat_id))
+        await bot.delete_message(chat_id=chat_id, message_id=trial["message_id"])
+        term_kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="1 час", callback_data=f"set_term:{defendant_id}:1"),
+             InlineKeyboardButton(text="1 день", callback_data=f"set_term:{defendant_id}:24")],
+            [InlineKeyboardButton(text="3 дня", callback_data=f"set_term:{defendant_id}:72"),
+             InlineKeyboardButton(text="Неделя", callback_data=f"set_term:{defendant_id}:168")]])
+        await bot.send_message(chat_id, f"<b>ВЕРДИКТ: ВИНОВЕН!</b>\n{prosecutor_name}, выбери срок наказания для {defendant_name}.", reply_markup=term_kb)
+    else:
+        row = await adb_query("UPDATE users SET size=max(0, size - 2) WHERE user_id=? AND chat_id=? RETURNING size",
+                              (prosecutor_id, chat_id), fetchone=True)
+        if row:
+            leaderboard.set_size(chat_id, prosecutor_id, row['size'])
+        await bot.delete_message(chat_id=chat_id, message_id=trial["message_id"])
+        await bot.send_message(chat_id, f"<b>ВЕРДИКТ: НЕВИНОВЕН!</b>\n{defendant_name} оправдан. Штраф обвинителю ({prosecutor_name}): -2 см.")
+
+async def on_punishment_end(chat_id: int, user_id: int):
+    user = await adb_query("SELECT status, punishment_end_time FROM users WHERE user_id = ? AND chat_id = ?",
+                           (user_id, chat_id), fetchone=True)
+    if not user or user['status'] != 'condemned' or not user['punishment_end_time']:
+        return
+    if not deadline_passed(user['punishment_end_time']):
+        scheduler.schedule((chat_id, 'punishment', user_id), datetime.fromisoformat(user['punishment_end_time']),
+                           on_punishment_end, chat_id, user_id)
+        return
+    user_name = await get_player_name(user_id, chat_id)
+    await adb_query("UPDATE users SET status='normal', condemned_by=NULL, punishment_end_time=NULL WHERE user_id=? AND chat_id=?", (user_id, chat_id))
+    await bot.send_message(chat_id, f"Время наказания для {user_name} истекло. Он снова на свободе.")
+
+async def rehydrate_timers():
+    # Re-arms every pending deadline after a restart; anything already overdue fires right away.
+    chats = await adb_query(
+        "SELECT chat_id, active_duel_json, active_trial_json FROM chats "
+        "WHERE active_duel_json IS NOT NULL OR active_trial_json IS NOT NULL",
+        fetchall=True)
+    for chat in chats:
+        chat_id = chat['chat_id']
+        if not owns_chat(chat_id):
+            continue
         try:
-            all_chats = db_query("SELECT * FROM chats", fetchall=True)
-            for chat in all_chats:
-                chat_id = chat['chat_id']
-                lang = get_lang(chat_id)
+            if chat['active_duel_json']:
+                duel = json.loads(chat['active_duel_json'])
+                scheduler.schedule((chat_id, 'duel'), datetime.fromisoformat(duel["end_time"]), on_duel_timeout, chat_id)
+            if chat['active_trial_json']:
+                trial = json.loads(chat['active_trial_json'])
+                scheduler.schedule((chat_id, 'trial'), datetime.fromisoformat(trial["end_time"]), on_trial_end, chat_id)
+        except (json.JSONDecodeError, KeyError, ValueError) as e:
+            logging.error(f"Error restoring timers for chat {chat_id} due to bad data: {e}. Resetting relevant state might be needed.")
+
+    # Blackjack games were already recovered into memory by load_blackjack_games.
+    for chat_id, game in blackjack_games.items():
+        if game.state == 'waiting':
+            scheduler.schedule((chat_id, 'bj_lobby'), game.end_time, on_blackjack_lobby_end, chat_id)
+        elif game.state == 'in_progress' and game.turn_end_time:
+            arm_blackjack_turn_timer(chat_id, game)
+        elif game.state == 'in_progress':
+            # Stopped between a move and the next turn starting.
+            scheduler.call_later((chat_id, 'bj_step'), 0, resume_blackjack, chat_id, process_next_player_turn)
+        elif game.state == 'dealer_turn':
+            scheduler.call_later((chat_id, 'bj_step'), 0, resume_blackjack, chat_id, dealer_step)
+
+    condemned_users = await adb_query(
+        "SELECT user_id, chat_id, punishment_end_time FROM users WHERE status = 'condemned' AND punishment_end_time IS NOT NULL",
+        fetchall=True)
+    for user in condemned_users:
+        if not owns_chat(user['chat_id']):
+            continue
+        scheduler.schedule((user['chat_id'], 'punishment', user['user_id']), datetime.fromisoformat(user['punishment_end_time']),
+                           on_punishment_end, user['chat_id'], user['user_id'])
+    logging.info(f"Restored {len(scheduler)} timers.")
+
+def webhook_app() -> web.Application:
+    # Updates are acknowledged as soon as the request is read (handle_in_background) and then fed to the
+    # same dispatcher; requests without the secret token Telegram echoes back are rejected.
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET,
+                         handle_in_background=True).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook():
+    runner = web.AppRunner(webhook_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                          allowed_updates=dp.resolve_used_update_types())
+    logging.info(f"Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, "
+                 f"ready {time.monotonic() - STARTED_AT:.2f}s after process start.")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def start_services():
+    global metrics_runner
+    metrics_runner = await start_metrics_server()
+    if db_profiler and hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, dump_query_profile)
+    await load_language_cache()
+    await load_leaderboard()
+    await load_blackjack_games()
+    await rehydrate_timers()
+    asyncio.create_task(scheduler.run())
+    asyncio.create_task(warm_chart_pool())
+    if LOOP_STALL_MS:
+        loop_watchdog.watch(*(handler.callback for name, observer in dp.observers.items() if name != "update"
+                              for handler in observer.handlers),
+                            on_duel_timeout, on_blackjack_lobby_end, on_blackjack_turn_timeout, on_trial_end,
+                            on_punishment_end, resume_blackjack, reveal_message)
+        loop_watchdog.start()
+
+async def stop_services():
+    loop_watchdog.stop()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    await db_writer.close()
+    db_write_executor.shutdown(wait=True)
+    db_read_executor.shutdown(wait=True)
+    chart_executor.shutdown(wait=False, cancel_futures=True)
+    close_db_connections()
+    logging.info(f"Rate limiter stats: {rate_limiter.stats()}")
+    if db_profiler:
+        dump_query_profile()
+
+# --- Sharding ---
+def update_chat_id(update: types.Update) -> int:
+    try:
+        event = update.event
+    except Exception:
+        return 0
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    if chat:
+        return chat.id
+    user = getattr(event, 'from_user', None)
+    return user.id if user else 0
+
+def worker_main(index: int, count: int, updates: multiprocessing.Queue):
+    global shard_index, shard_count
+    shard_index, shard_count = index, count
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - worker {index} - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(run_worker(updates))
+    except KeyboardInterrupt:
+        pass
+
+async def run_worker(updates: multiprocessing.Queue):
+    # Owns the chats of one shard: only their games and timers are loaded here, so every deadline
+    # is armed in exactly one process.
+    loop = asyncio.get_running_loop()
+    edit_queue.global_interval *= shard_count  # the global edit budget is shared by all workers
+    reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="updates")
+    tasks = set()
+    await start_services()
+    logging.info(f"Worker {shard_index}/{shard_count} ready.")
+    try:
+        while True:
+            raw = await loop.run_in_executor(reader, updates.get)
+            if raw is None:
+                break
+            update = types.Update.model_validate(json.loads(raw), context={"bot": bot})
+            task = asyncio.create_task(feed_update(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks, timeout=10)
+    finally:
+        reader.shutdown(wait=False)
+        await stop_services()
+
+async def feed_update(update: types.Update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        logging.error(f"Update {update.update_id} failed: {e}", exc_info=True)
+
+async def run_supervisor(count: int):
+    # SQLite in WAL mode lets every worker read concurrently; their writers serialize on the database
+    # lock (busy_timeout) and never touch each other's chats.
+    context = multiprocessing.get_context('spawn')
+    queues: list = [None] * count
+    workers: list = [None] * count
+
+    def spawn(index: int):
+        queues[index] = context.Queue()
+        workers[index] = context.Process(target=worker_main, args=(index, count, queues[index]), name=f"worker-{index}")
+        workers[index].start()
+
+    async def watch_workers():
+        # A dead worker is replaced under the same index; the new one reloads its shard's games and
+        # timers from the database on start. It gets a new queue: the dead one may have died holding
+        # the old queue's read lock, so updates still buffered there are lost.
+        while True:
+            await asyncio.sleep(WORKER_CHECK_SECONDS)
+            for index, worker in enumerate(workers):
+                if worker.is_alive():
+                    continue
                 try:
-                    if chat['active_duel_json']:
-                        duel = json.loads(chat['active_duel_json'])
-                        if now > datetime.fromisoformat(duel["end_time"]):
-                            await bot.edit_message_text(
-                                text="Время вышло! Вызов на дуэль отменен.",
-                                chat_id=chat_id,
-                                message_id=duel["message_id"]
-                            )
-                            db_query("UPDATE chats SET active_duel_json = NULL WHERE chat_id = ?", (chat_id,))
-
-                    if chat['active_blackjack_json']:
-                        game = get_blackjack_game(chat_id)
-                        if game and game.get('state') == 'waiting' and now > datetime.fromisoformat(game["end_time"]):
-                            logging.info(f"[BJ_TIMER_EXPIRED] Chat {chat_id}: Lobby timer expired. Forcing game start.")
-                            if game.get('expecting_bet_from') is not None:
-                                logging.warning(f"[BJ_BET_TIMEOUT] Chat {chat_id}: User {game['expecting_bet_from']} did not bet in time.")
-                                game['expecting_bet_from'] = None
-                                save_blackjack_game(chat_id, game)
-                            await start_blackjack_game_logic(chat_id)
-                        
-                        if game and game.get('state') == 'in_progress' and game.get('turn_end_time'):
-                            if now > datetime.fromisoformat(game['turn_end_time']):
-                                player_ids = list(game['players'].keys())
-                                current_player_id_str = player_ids[game['current_player_index']]
-                                current_player_name = await get_player_name(int(current_player_id_str), chat_id)
-                                
-                                logging.warning(f"[BJ_TURN_TIMEOUT] Chat {chat_id}: Player {current_player_id_str} timed out.")
-                                
-                                game['players'][current_player_id_str]['status'] = 'stood'
-                                game['current_player_index'] += 1
-                                game['turn_end_time'] = None
-                                save_blackjack_game(chat_id, game)
-                                
-                                await bot.send_message(chat_id, t('bj_turn_timeout', lang, name=current_player_name))
-                                await process_next_player_turn(chat_id)
-
-
-                    if chat['active_trial_json']:
-                        trial = json.loads(chat['active_trial_json'])
-                        if now > datetime.fromisoformat(trial["end_time"]):
-                            prosecutor_id, defendant_id = trial["prosecutor_id"], trial["defendant_id"]
-                            prosecutor_name = await get_player_name(prosecutor_id, chat_id)
-                            defendant_name = await get_player_name(defendant_id, chat_id)
-                            guilty_count, innocent_count = len(trial["votes"]["guilty"]), len(trial["votes"]["innocent"])
-                            if guilty_count > innocent_count and (guilty_count + innocent_count) >= 1:
-                                db_query("UPDATE users SET status='condemned', condemned_by=? WHERE user_id=? AND chat_id=?", (prosecutor_id, defendant_id, chat_id))
-                                await bot.delete_message(chat_id=chat_id, message_id=trial["message_id"])
-                                term_kb = InlineKeyboardMarkup(inline_keyboard=[
-                                    [InlineKeyboardButton(text="1 час", callback_data=f"set_term:{defendant_id}:1"),
-                                     InlineKeyboardButton(text="1 день", callback_data=f"set_term:{defendant_id}:24")],
-                                    [InlineKeyboardButton(text="3 дня", callback_data=f"set_term:{defendant_id}:72"),
-                                     InlineKeyboardButton(text="Неделя", callback_data=f"set_term:{defendant_id}:168")]])
-                                await bot.send_message(chat_id, f"<b>ВЕРДИКТ: ВИНОВЕН!</b>\n{prosecutor_name}, выбери срок наказания для {defendant_name}.", reply_markup=term_kb)
-                            else:
-                                await bot.delete_message(chat_id=chat_id, message_id=trial["message_id"])
-                                await bot.send_message(chat_id, f"<b>ВЕРДИКТ: НЕВИНОВЕН!</b>\n{defendant_name} оправдан. Штраф обвинителю ({prosecutor_name}): -2 см.")
-                                db_query("UPDATE users SET size=max(0, size - 2) WHERE user_id=? AND chat_id=?", (prosecutor_id, chat_id))
-                            db_query("UPDATE chats SET active_trial_json = NULL WHERE chat_id = ?", (chat_id,))
-                except (json.JSONDecodeError, KeyError) as e:
-                    logging.error(f"Error processing event for chat {chat_id} due to bad data: {e}. Resetting relevant state might be needed.")
-                except TelegramBadRequest as e:
-                    logging.error(f"Telegram API error for chat {chat_id}: {e}")
-                except Exception as e:
-                    logging.error(f"An unexpected error occurred while processing chat {chat_id}: {e}", exc_info=True)
-            
-            condemned_users = db_query("SELECT * FROM users WHERE status = 'condemned' AND punishment_end_time IS NOT NULL", fetchall=True)
-            for user in condemned_users:
-                if now > datetime.fromisoformat(user["punishment_end_time"]):
-                    user_name = await get_player_name(user['user_id'], user['chat_id'])
-                    db_query("UPDATE users SET status='normal', condemned_by=NULL, punishment_end_time=NULL WHERE user_id=? AND chat_id=?", (user['user_id'], user['chat_id']))
-                    await bot.send_message(user['chat_id'], f"Время наказания для {user_name} истекло. Он снова на свободе.")
+                    buffered = queues[index].qsize()
+                except NotImplementedError:
+                    buffered = "unknown"
+                logging.error(f"Worker {index} exited with code {worker.exitcode}, restarting it "
+                              f"({buffered} buffered updates dropped).")
+                queues[index].cancel_join_thread()
+                queues[index].close()
+                spawn(index)
+
+    def route(update: types.Update, raw: str):
+        queues[update_chat_id(update) % count].put(raw)
+
+    for index in range(count):
+        spawn(index)
+    watcher = asyncio.create_task(watch_workers())
+    try:
+        if WEBHOOK_URL:
+            await run_sharded_webhook(route)
+        else:
+            await run_sharded_polling(route)
+    finally:
+        watcher.cancel()
+        for updates in queues:
+            updates.put(None)
+        loop = asyncio.get_running_loop()
+        for worker in workers:
+            await loop.run_in_executor(None, worker.join, 30)
+        await bot.session.close()
+
+async def run_sharded_polling(route: Callable[[types.Update, str], None]):
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    logging.info(f"Supervisor polling for {WORKERS} workers, ready {time.monotonic() - STARTED_AT:.2f}s after process start.")
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
         except Exception as e:
-            logging.error(f"FATAL: Unhandled exception in background_tasks main loop: {e}", exc_info=True)
+            logging.error(f"Failed to fetch updates: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            route(update, update.model_dump_json(by_alias=True, exclude_none=True))
+
+async def run_sharded_webhook(route: Callable[[types.Update, str], None]):
+    async def handle(request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+            return web.Response(status=401)
+        raw = await request.text()
+        route(types.Update.model_validate_json(raw), raw)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                          allowed_updates=dp.resolve_used_update_types())
+    logging.info(f"Supervisor webhook on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} for {WORKERS} workers.")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 async def main() -> None:
-    init_db()
-    asyncio.create_task(background_tasks())
-    await dp.start_polling(bot)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(db_write_executor, init_db)
+    if WORKERS > 1:
+        try:
+            await run_supervisor(WORKERS)
+        finally:
+            db_write_executor.shutdown(wait=True)
+            close_db_connections()
+        return
+    await start_services()
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            logging.info(f"Ready to poll {time.monotonic() - STARTED_AT:.2f}s after process start.")
+            await dp.start_polling(bot)
+    finally:
+        await stop_services()
 
-if __name__ == "__main__":
+def run():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     asyncio.run(main())
+
+if __name__ == "__main__":
+    run()
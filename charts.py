@@ -0,0 +1,185 @@
+import functools
+import importlib.util
+import io
+import logging
+import os
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+# Renderers run in worker processes: they take plain data, return image bytes and never touch the disk.
+# matplotlib is imported on first use, so importing this module (the bot does) stays cheap.
+_plt = None
+
+
+def _pyplot():
+    global _plt
+    if _plt is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        _plt = plt
+    return _plt
+
+
+def warm_up():
+    # Worker initializer: pays for font loading and the matplotlib import before the first render.
+    # It must not raise, since a failing initializer breaks the whole pool, and the Pillow renderer
+    # does not need matplotlib at all; a broken matplotlib only fails render_top_chart.
+    for size in (18, 20, 22, 24, 34):
+        _font(size)
+        _font(size, True)
+    try:
+        _pyplot().style.use('dark_background')
+    except Exception as e:
+        logging.warning(f"matplotlib is unavailable, only the Pillow renderer will work: {e}")
+
+
+def _to_png(fig, **kwargs) -> bytes:
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight', **kwargs)
+    _pyplot().close(fig)
+    return buffer.getvalue()
+
+
+def _dealer_line(dealer) -> str:
+    return f"{dealer['label']}: {' '.join(dealer['cards'])} ({dealer['value']}){dealer['status']}"
+
+
+def render_top_chart(players, sizes, xlabel, title) -> bytes:
+    plt = _pyplot()
+    plt.style.use('dark_background')
+    fig, ax = plt.subplots()
+    bars = ax.barh(players, sizes, color='#0088cc')
+    ax.invert_yaxis()
+    ax.set_xlabel(xlabel)
+    ax.set_title(title)
+    ax.bar_label(bars, fmt='%d см', label_type='edge', color='white', padding=5)
+    fig.tight_layout()
+    return _to_png(fig, dpi=200)
+
+
+def render_blackjack_results_mpl(title, dealer, results, hand_label, balance_label) -> bytes:
+    plt = _pyplot()
+    plt.style.use('dark_background')
+    fig, ax = plt.subplots(figsize=(8, 4 + len(results) * 1.5))
+    fig.patch.set_facecolor('#1c1c1c')
+    ax.set_facecolor('#1c1c1c')
+
+    ax.set_title(title, fontsize=20, color='white', pad=20)
+    ax.axis('off')
+
+    ax.text(0.5, 0.9, _dealer_line(dealer), ha='center', va='center', fontsize=14, color='cyan')
+
+    y_pos = 0.8
+    for data in results:
+        ax.text(0.05, y_pos, data['name'], ha='left', va='center', fontsize=14, color='white', weight='bold')
+        ax.text(0.05, y_pos - 0.05, f"{hand_label}: {' '.join(data['cards'])} ({data['value']})", ha='left', va='center', fontsize=12, color='lightgrey')
+        ax.text(0.95, y_pos, data['result_text'], ha='right', va='center', fontsize=14, color=data['color'], weight='bold')
+        ax.text(0.95, y_pos - 0.05, f"{balance_label}: {data['balance_text']}", ha='right', va='center', fontsize=12, color='lightgrey')
+        y_pos -= 0.15
+
+    fig.tight_layout(pad=2.0)
+    return _to_png(fig, dpi=150, facecolor=fig.get_facecolor())
+
+
+# --- Sprite renderer ---
+# Same layout as render_blackjack_results_mpl, composited with Pillow from cached text and card sprites.
+# Encoded as JPEG: Telegram recompresses photos to JPEG anyway, and PNG encoding alone would cost
+# several times the compositing.
+RESULTS_WIDTH = 1000
+RESULTS_MARGIN = 40
+RESULTS_TOP = 200
+RESULTS_ROW_HEIGHT = 120
+RESULTS_BACKGROUND = '#1c1c1c'
+RED_SUITS = ('♥', '♦')
+
+_mpl_spec = importlib.util.find_spec('matplotlib')
+FONT_DIR = os.path.join(_mpl_spec.submodule_search_locations[0], 'mpl-data', 'fonts', 'ttf') if _mpl_spec else ''
+
+
+@functools.lru_cache(maxsize=None)
+def _font(size, bold=False):
+    try:
+        return ImageFont.truetype(os.path.join(FONT_DIR, 'DejaVuSans-Bold.ttf' if bold else 'DejaVuSans.ttf'), size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+
+@functools.lru_cache(maxsize=4096)
+def _text_sprite(text, size, color, bold=False):
+    font = _font(size, bold)
+    ascent, descent = font.getmetrics()
+    sprite = Image.new('RGBA', (max(1, int(font.getlength(text)) + 1), ascent + descent), (0, 0, 0, 0))
+    ImageDraw.Draw(sprite).text((0, 0), text, font=font, fill=color)
+    return sprite
+
+
+@functools.lru_cache(maxsize=None)
+def _card_sprite(label, size):
+    text = _text_sprite(label, size, '#cc0000' if label[-1] in RED_SUITS else '#111111', True)
+    pad = size // 3
+    sprite = Image.new('RGBA', (text.width + 2 * pad, text.height + pad), (0, 0, 0, 0))
+    ImageDraw.Draw(sprite).rounded_rectangle((0, 0, sprite.width - 1, sprite.height - 1), radius=pad, fill='#f4f4f4')
+    sprite.alpha_composite(text, (pad, pad // 2))
+    return sprite
+
+
+def _paste_line(image, sprites, x, y, align='left', gap=6):
+    # y is the vertical centre of the line, like va='center' in matplotlib.
+    width = sum(sprite.width for sprite in sprites) + gap * (len(sprites) - 1)
+    if align == 'center':
+        x -= width // 2
+    elif align == 'right':
+        x -= width
+    for sprite in sprites:
+        image.paste(sprite, (x, y - sprite.height // 2), sprite)
+        x += sprite.width + gap
+
+
+def render_blackjack_results(title, dealer, results, hand_label, balance_label) -> bytes:
+    height = RESULTS_TOP + len(results) * RESULTS_ROW_HEIGHT
+    image = Image.new('RGB', (RESULTS_WIDTH, height), RESULTS_BACKGROUND)
+    center, right = RESULTS_WIDTH // 2, RESULTS_WIDTH - RESULTS_MARGIN
+
+    _paste_line(image, [_text_sprite(title, 34, 'white')], center, 55, 'center')
+    _paste_line(image, [_text_sprite(f"{dealer['label']}:", 24, 'cyan'),
+                        *(_card_sprite(card, 22) for card in dealer['cards']),
+                        _text_sprite(f"({dealer['value']}){dealer['status']}", 24, 'cyan')], center, 125, 'center')
+
+    y = RESULTS_TOP
+    for data in results:
+        _paste_line(image, [_text_sprite(data['name'], 24, 'white', True)], RESULTS_MARGIN, y)
+        _paste_line(image, [_text_sprite(f"{hand_label}:", 20, 'lightgrey'),
+                            *(_card_sprite(card, 18) for card in data['cards']),
+                            _text_sprite(f"({data['value']})", 20, 'lightgrey')], RESULTS_MARGIN, y + 42)
+        _paste_line(image, [_text_sprite(data['result_text'], 24, data['color'], True)], right, y, 'right')
+        _paste_line(image, [_text_sprite(f"{balance_label}: {data['balance_text']}", 20, 'lightgrey')], right, y + 42, 'right')
+        y += RESULTS_ROW_HEIGHT
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+if __name__ == '__main__':
+    # Benchmark: python charts.py
+    sample_dealer = {'label': "Рука дилера", 'cards': ['K♥', '7♣', '5♦'], 'value': 22, 'status': " (Перебор!)"}
+    sample_results = [
+        {'name': f"Игрок {i}", 'cards': ['A♠', '9♥'][:2 + i % 2] + ['2♦'] * (i % 3), 'value': 20 + i % 2,
+         'result_text': "Победа! (+10 см)", 'color': '#55FF55', 'balance_text': f"{40 + i} → {50 + i} см"}
+        for i in range(5)
+    ]
+    sample_args = ("Итоги игры в Блэкджек", sample_dealer, sample_results, "Карты", "Баланс")
+    start = time.perf_counter()
+    warm_up()
+    print(f"warm_up: {(time.perf_counter() - start) * 1000:.0f} ms")
+    for renderer in (render_blackjack_results_mpl, render_blackjack_results):
+        renderer(*sample_args)  # first render fills the sprite caches
+        runs = 20
+        start = time.perf_counter()
+        for _ in range(runs):
+            image = renderer(*sample_args)
+        elapsed = (time.perf_counter() - start) / runs
+        print(f"{renderer.__name__}: {elapsed * 1000:.1f} ms per image, {len(image)} bytes")
@@ -0,0 +1,6 @@
+# Starts the bot: python run.py
+# Chart workers are spawned processes, and a spawned process re-imports the main script. Started
+# from this file they import nothing but charts, instead of loading a second copy of the bot.
+if __name__ == "__main__":
+    import bot
+    bot.run()
@@ -0,0 +1,180 @@
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ["METRICS_PORT"] = "0"
+os.environ["LOOP_STALL_MS"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from aiogram import types  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+
+CHAT_ID = -100
+
+
+class FakeSession(BaseSession):
+    # Answers Bot API calls locally and records them; every send gets a fresh message_id.
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.call_times = []  # perf_counter() of every call, for latency measurements
+        self._message_ids = itertools.count(1000)
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        result = True
+        if name.startswith("Send"):
+            photo = None
+            if name == "SendPhoto":
+                photo = [types.PhotoSize(file_id=f"photo-{len(self.calls)}", file_unique_id="p", width=1, height=1)]
+            result = types.Message(message_id=next(self._message_ids), date=datetime.now(),
+                                   chat=types.Chat(id=method.chat_id, type="supergroup"),
+                                   text=getattr(method, "text", None), photo=photo)
+        self.calls.append((name, method, result))
+        self.call_times.append(time.perf_counter())
+        return result
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    def sent(self, name="SendMessage"):
+        return [result for method_name, _, result in self.calls if method_name == name]
+
+    def methods(self, name):
+        return [method for method_name, method, _ in self.calls if method_name == name]
+
+
+class Harness:
+    # Builds updates the way Telegram sends them and feeds them to the real dispatcher.
+    chat_id = CHAT_ID
+
+    def __init__(self, session: FakeSession):
+        self.session = session
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def run(self, scenario):
+        # Runs scenario(harness) with the scheduler loop going, the way start_services runs it.
+        async def main():
+            scheduler_task = asyncio.create_task(bot.scheduler.run())
+            try:
+                return await scenario(self)
+            finally:
+                scheduler_task.cancel()
+                await bot.db_writer.close()
+        return asyncio.run(main())
+
+    @staticmethod
+    async def wait_for(predicate, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                raise AssertionError("condition not reached in time")
+            await asyncio.sleep(0.01)
+
+    @staticmethod
+    def user(user_id):
+        return types.User(id=user_id, is_bot=False, first_name=f"Player {user_id}", username=f"player{user_id}")
+
+    def message(self, user_id, text, reply_to=None, chat_id=CHAT_ID):
+        reply = None
+        if reply_to is not None:
+            reply = types.Message(message_id=next(self._message_ids), date=datetime.now(),
+                                  chat=types.Chat(id=chat_id, type="supergroup"), from_user=self.user(reply_to),
+                                  text="...")
+        return types.Message(message_id=next(self._message_ids), date=datetime.now(),
+                             chat=types.Chat(id=chat_id, type="supergroup"), from_user=self.user(user_id), text=text,
+                             reply_to_message=reply)
+
+    async def send(self, user_id, text, reply_to=None, chat_id=CHAT_ID):
+        update = types.Update(update_id=next(self._update_ids),
+                              message=self.message(user_id, text, reply_to, chat_id))
+        return await bot.dp.feed_update(bot.bot, update)
+
+    async def click(self, user_id, data, message_id, chat_id=CHAT_ID):
+        callback = types.CallbackQuery(
+            id=str(next(self._update_ids)), from_user=self.user(user_id), chat_instance="test", data=data,
+            message=types.Message(message_id=message_id, date=datetime.now(),
+                                  chat=types.Chat(id=chat_id, type="supergroup"), text="..."))
+        return await bot.dp.feed_update(bot.bot, types.Update(update_id=next(self._update_ids), callback_query=callback))
+
+    async def start_players(self, *user_ids, chat_id=CHAT_ID):
+        for user_id in user_ids:
+            await self.send(user_id, "/start", chat_id=chat_id)
+        # /start counts as today's growth; clear it so /grow is available right away.
+        await bot.adb_query("UPDATE users SET last_growth = NULL WHERE chat_id = ?", (chat_id,))
+
+    async def size(self, user_id, chat_id=CHAT_ID):
+        row = await bot.adb_query("SELECT size FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id),
+                                  fetchone=True)
+        return row['size']
+
+    async def expire_trial(self, chat_id=CHAT_ID):
+        row = await bot.adb_query("SELECT active_trial_json FROM chats WHERE chat_id = ?", (chat_id,), fetchone=True)
+        trial = json.loads(row['active_trial_json'])
+        trial['end_time'] = (datetime.now() - timedelta(seconds=1)).isoformat()
+        await bot.adb_query("UPDATE chats SET active_trial_json = ? WHERE chat_id = ?", (json.dumps(trial), chat_id))
+        await bot.on_trial_end(chat_id)
+
+    async def start_blackjack(self, host_id, bet, *joiners, chat_id=CHAT_ID):
+        # Opens a lobby, lets every joiner bet and then closes the lobby; returns the game.
+        await self.send(host_id, f"/blackjack {bet}", chat_id=chat_id)
+        game = bot.blackjack_games[chat_id]
+        for user_id in joiners:
+            await self.click(user_id, "blackjack_join", game.message_id, chat_id)
+            await self.send(user_id, str(bet), chat_id=chat_id)
+        game.end_time = datetime.now() - timedelta(seconds=1)
+        await bot.on_blackjack_lobby_end(chat_id)
+        await self.wait_for(lambda: game.state != 'in_progress' or game.turn_end_time is not None)
+        return game
+
+
+async def no_chart(renderer, *args):
+    return None
+
+
+@pytest.fixture
+def harness(tmp_path, monkeypatch):
+    # A fresh database, fresh in-memory state and a fake Bot API for every test. Everything that
+    # binds to an event loop is recreated, so each test can run its own asyncio.run().
+    read_executor = ThreadPoolExecutor(max_workers=bot.DB_READ_THREADS, initializer=bot._mark_read_only_thread)
+    write_executor = ThreadPoolExecutor(max_workers=1)
+    session = FakeSession()
+    monkeypatch.setattr(bot, "DB_FILE", str(tmp_path / "wombat.db"))
+    monkeypatch.setattr(bot, "db_read_executor", read_executor)
+    monkeypatch.setattr(bot, "db_write_executor", write_executor)
+    monkeypatch.setattr(bot, "db_writer", bot.DBWriter(bot.DB_WRITE_FLUSH_INTERVAL, bot.DB_WRITE_MAX_BATCH))
+    monkeypatch.setattr(bot, "scheduler", bot.TimerScheduler(bot.TIMER_CONCURRENCY, bot.TIMER_CALLBACK_TIMEOUT_SECONDS))
+    monkeypatch.setattr(bot, "edit_queue", bot.EditQueue(0, 1000))
+    monkeypatch.setattr(bot, "chat_locks", bot.KeyedLocks())
+    monkeypatch.setattr(bot, "rate_limiter", bot.RateLimiter(bot.SPAM_TRACKED_USERS, bot.SPAM_STATE_TTL_SECONDS))
+    monkeypatch.setattr(bot, "leaderboard", bot.Leaderboard())
+    monkeypatch.setattr(bot, "player_names", bot.LRUCache(bot.PLAYER_NAME_CACHE_SIZE))
+    monkeypatch.setattr(bot, "top_charts", bot.LRUCache(bot.TOP_CHART_CACHE_SIZE))
+    monkeypatch.setattr(bot, "chat_languages", {})
+    monkeypatch.setattr(bot, "trial_tallies", {})
+    monkeypatch.setattr(bot, "blackjack_games", {})
+    monkeypatch.setattr(bot, "render_chart", no_chart)
+    monkeypatch.setattr(bot, "SPAM_COOLDOWN_SECONDS", 1e-6)
+    monkeypatch.setattr(bot, "COMMAND_RATE_LIMITS", {})
+    for delay in ("CASINO_REVEAL_SECONDS", "DUEL_REVEAL_SECONDS", "BLACKJACK_DEAL_SECONDS",
+                  "BLACKJACK_DEALER_FIRST_CARD_SECONDS", "BLACKJACK_DEALER_CARD_SECONDS", "BLACKJACK_NEXT_TURN_SECONDS"):
+        monkeypatch.setattr(bot, delay, 0)
+    monkeypatch.setattr(bot.bot, "session", session)
+    bot.init_db()
+    yield Harness(session)
+    read_executor.shutdown(wait=True)
+    write_executor.shutdown(wait=True)
+    bot.close_db_connections()
@@ -0,0 +1,35 @@
+import asyncio
+import os
+
+import bot
+import charts
+
+DEALER = {'label': "Рука дилера", 'cards': ['K♥', '7♣'], 'value': 17, 'status': ""}
+RESULTS = [{'name': "Игрок", 'cards': ['A♠', '9♥'], 'value': 20, 'result_text': "Победа! (+10 см)",
+            'color': '#55FF55', 'balance_text': "40 → 50 см"}]
+
+
+def test_warm_up_survives_broken_matplotlib(monkeypatch):
+    def broken():
+        raise ImportError("no matplotlib")
+
+    monkeypatch.setattr(charts, "_pyplot", broken)
+    charts.warm_up()
+    image = charts.render_blackjack_results("Итоги", DEALER, RESULTS, "Карты", "Баланс")
+    assert image[:2] == b'\xff\xd8'
+
+
+def test_render_pool_is_replaced_after_a_worker_dies(monkeypatch):
+    monkeypatch.setattr(bot, "chart_executor", bot.new_chart_executor())
+
+    async def main():
+        broken = bot.chart_executor
+        assert await bot.render_chart(os._exit, 1) is None
+        assert bot.chart_executor is not broken
+        return await bot.render_chart(charts.render_blackjack_results, "Итоги", DEALER, RESULTS, "Карты", "Баланс")
+
+    try:
+        image = asyncio.run(main())
+    finally:
+        bot.chart_executor.shutdown()
+    assert image[:2] == b'\xff\xd8'
@@ -0,0 +1,156 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import bot
+
+
+def answers(session, text):
+    return [method for method in session.methods("AnswerCallbackQuery") if method.text == text]
+
+
+def test_keyed_locks_serialize_per_key_and_evict():
+    locks = bot.KeyedLocks()
+    order = []
+
+    async def worker(key, tag):
+        async with locks.hold(key):
+            order.append(("in", key, tag))
+            await asyncio.sleep(0.01)
+            order.append(("out", key, tag))
+
+    async def main():
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(*(worker(key, tag) for key in ("a", "b") for tag in range(5)))
+        return asyncio.get_running_loop().time() - started
+
+    elapsed = asyncio.run(main())
+    for key in ("a", "b"):
+        events = [event for event in order if event[1] == key]
+        assert all(events[i][0] == "in" and events[i + 1] == ("out", key, events[i][2]) for i in range(0, len(events), 2))
+    assert elapsed < 0.09  # the two keys ran side by side, not one after the other
+    assert len(locks) == 0
+
+
+def test_double_clicked_stand_and_timeout_settle_once(harness):
+    chat = harness.chat_id
+
+    async def scenario(h):
+        await h.start_players(1, 2)
+        game = await h.start_blackjack(1, 1, 2)
+        assert game.player_ids == [1, 2] and game.current_player_id() == 1
+
+        await asyncio.gather(*(h.click(1, "blackjack_stand", game.message_id) for _ in range(5)))
+        assert game.current_player_index == 1
+        assert game.players[1].status == 'stood'
+        assert len(answers(h.session, "Сейчас не ваш ход!")) == 4
+
+        sizes = {user_id: await h.size(user_id) for user_id in (1, 2)}
+        game.turn_end_time = datetime.now() - timedelta(seconds=1)
+        await asyncio.gather(bot.on_blackjack_turn_timeout(chat),
+                             *(h.click(2, "blackjack_stand", game.message_id) for _ in range(5)))
+        await h.wait_for(lambda: chat not in bot.blackjack_games)
+        await h.wait_for(lambda: any(bot.t('bj_results_title', 'ru') in (message.text or '')
+                                     for message in h.session.sent()))
+
+        results = [message for message in h.session.sent() if bot.t('bj_results_title', 'ru') in (message.text or '')]
+        assert len(results) == 1
+        for user_id in (1, 2):
+            assert await h.size(user_id) - sizes[user_id] in (-1, 0, 1)
+        assert len(bot.chat_locks) == 0
+
+    harness.run(scenario)
+
+
+def test_concurrent_hits_deal_each_card_once(harness):
+    chat = harness.chat_id
+
+    async def scenario(h):
+        await h.start_players(1)
+        game = await h.start_blackjack(1, 1)
+        dealer_cards = len(game.dealer_hand)
+        await asyncio.gather(*(h.click(1, "blackjack_hit", game.message_id) for _ in range(8)))
+
+        hand = list(game.players[1].hand)
+        accepted = len(answers(h.session, None))
+        rejected = len(answers(h.session, "Сейчас не ваш ход!")) + len(answers(h.session, "Игра неактивна."))
+        assert accepted + rejected == 8
+        assert len(hand) == 2 + accepted
+        cards = hand + list(game.dealer_hand)[:dealer_cards] + list(game.deck)
+        assert len(cards) == len(set(cards))
+        await h.wait_for(lambda: chat not in bot.blackjack_games or game.turn_end_time is not None)
+        assert len(bot.chat_locks) == 0
+
+    harness.run(scenario)
+
+
+def test_double_clicked_duel_accept_transfers_once(harness):
+    async def scenario(h):
+        await h.start_players(1, 2)
+        total = await h.size(1) + await h.size(2)
+        await h.send(1, "/duel", reply_to=2)
+        duel_message = h.session.sent()[-1]
+
+        await asyncio.gather(*(h.click(2, "duel_accept", duel_message.message_id) for _ in range(6)))
+
+        accepted = [method for method in h.session.methods("EditMessageText") if "принимает вызов" in method.text]
+        assert len(accepted) == 1
+        stale = "Этот вызов на дуэль уже недействителен."
+        rejected = [method for method in h.session.methods("EditMessageText") if method.text == stale]
+        assert len(rejected) + len(answers(h.session, stale)) == 5
+        assert await h.size(1) + await h.size(2) == total
+        assert len(bot.chat_locks) == 0
+
+    harness.run(scenario)
+
+
+def test_concurrent_votes_count_once_per_voter(harness):
+    chat = harness.chat_id
+
+    async def scenario(h):
+        await h.start_players(1, 2, 3, 4)
+        await h.send(1, "/trial", reply_to=2)
+        trial_message = h.session.sent()[-1]
+
+        await asyncio.gather(*(h.click(3, "vote_guilty", trial_message.message_id) for _ in range(5)),
+                             *(h.click(4, "vote_innocent", trial_message.message_id) for _ in range(5)))
+
+        rows = await bot.adb_query("SELECT user_id, vote FROM trial_votes WHERE chat_id = ? ORDER BY user_id",
+                                   (chat,), fetchall=True)
+        assert rows == [{'user_id': 3, 'vote': 'guilty'}, {'user_id': 4, 'vote': 'innocent'}]
+        assert bot.trial_tallies[(chat, trial_message.message_id)] == {'guilty': 1, 'innocent': 1}
+        assert len(answers(h.session, "Вы уже проголосовали.")) == 8
+        await h.wait_for(lambda: bot.edit_queue.pending() == 0)
+        await asyncio.sleep(0.05)
+        last_edit = h.session.methods("EditMessageText")[-1]
+        assert "'Виновен': 1 | 'Невиновен': 1" in last_edit.text
+        assert len(bot.chat_locks) == 0
+
+    harness.run(scenario)
+
+
+def test_grow_keeps_a_transfer_committed_after_its_read(harness, monkeypatch):
+    chat = harness.chat_id
+    adb_query = bot.adb_query
+
+    async def query_then_transfer(query, params=(), **kwargs):
+        # Another update pays player 1 right after /grow has read the row.
+        result = await adb_query(query, params, **kwargs)
+        if query.startswith("SELECT * FROM users"):
+            await adb_query("UPDATE users SET size = size + 100 WHERE user_id = ? AND chat_id = ?", (1, chat))
+        return result
+
+    async def scenario(h):
+        await h.start_players(1)
+        before = await h.size(1)
+        monkeypatch.setattr(bot, "adb_query", query_then_transfer)
+        await h.send(1, "/grow")
+        monkeypatch.setattr(bot, "adb_query", adb_query)
+
+        reply = h.session.sent()[-1].text
+        after = await h.size(1)
+        assert after >= before + 100
+        assert bot.leaderboard.rank(chat, 1) is not None and bot.leaderboard.top(chat, 1) == [(1, after)]
+        if after > before + 100:
+            assert str(after) in reply
+
+    harness.run(scenario)
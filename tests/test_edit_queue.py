@@ -0,0 +1,54 @@
+import asyncio
+
+import bot
+
+
+def test_burst_of_edits_collapses_to_latest(harness):
+    async def scenario(h):
+        queue = bot.edit_queue = bot.EditQueue(0.1, 1000)
+        for i in range(50):
+            queue.edit(h.chat_id, 7, f"state {i}")
+        await h.wait_for(lambda: queue.pending() == 0)
+        await asyncio.sleep(0.15)
+        edits = h.session.methods("EditMessageText")
+        assert 1 <= len(edits) <= 2
+        assert edits[-1].text == "state 49"
+
+    harness.run(scenario)
+
+
+def test_discarded_edit_is_never_sent(harness):
+    async def scenario(h):
+        queue = bot.edit_queue = bot.EditQueue(0.1, 1000)
+        queue.edit(h.chat_id, 7, "first")
+        queue.edit(h.chat_id, 8, "other message")
+        await asyncio.sleep(0)
+        queue.edit(h.chat_id, 7, "stale")
+        queue.discard(h.chat_id, 7)
+        queue.discard(h.chat_id, 8)
+        queue.edit(h.chat_id, 9, "after discard")
+        await asyncio.sleep(0.4)
+        assert [(method.message_id, method.text) for method in h.session.methods("EditMessageText")] == [
+            (7, "first"), (9, "after discard")]
+        assert queue.pending() == 0
+
+    harness.run(scenario)
+
+
+def test_trial_message_is_not_edited_after_deletion(harness):
+    async def scenario(h):
+        # A slow per-chat interval keeps the second vote count waiting in the queue at the verdict.
+        bot.edit_queue = bot.EditQueue(0.3, 1000)
+        await h.start_players(1, 2, 3, 4)
+        await h.send(1, "/trial", reply_to=2)
+        trial_message = h.session.sent()[-1]
+        await h.click(3, "vote_guilty", trial_message.message_id)
+        await h.click(4, "vote_guilty", trial_message.message_id)
+        await h.expire_trial()
+        await asyncio.sleep(0.5)
+
+        calls = [(name, getattr(method, "message_id", None)) for name, method, _ in h.session.calls]
+        deleted_at = calls.index(("DeleteMessage", trial_message.message_id))
+        assert ("EditMessageText", trial_message.message_id) not in calls[deleted_at:]
+
+    harness.run(scenario)
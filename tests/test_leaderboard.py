@@ -0,0 +1,87 @@
+import random
+
+import bot
+
+
+async def assert_matches_db(chat_id):
+    rows = await bot.adb_query("SELECT user_id, size FROM users WHERE chat_id = ? ORDER BY size DESC, user_id",
+                               (chat_id,), fetchall=True)
+    assert bot.leaderboard.top(chat_id, 15) == [(row['user_id'], row['size']) for row in rows][:15]
+    for row in rows:
+        better = sum(1 for other in rows if other['size'] > row['size'])
+        assert bot.leaderboard.rank(chat_id, row['user_id']) == (better + 1, len(rows))
+
+
+def test_leaderboard_matches_sorted_sizes():
+    board = bot.Leaderboard()
+    rng = random.Random(7)
+    sizes = {}
+    for _ in range(2000):
+        user_id, size = rng.randrange(50), rng.randrange(30)
+        board.set_size(1, user_id, size)
+        sizes[user_id] = size
+    expected = sorted(sizes.items(), key=lambda item: (-item[1], item[0]))
+    assert board.top(1, 15) == expected[:15]
+    for user_id, size in sizes.items():
+        assert board.rank(1, user_id) == (1 + sum(1 for other in sizes.values() if other > size), len(sizes))
+    assert board.rank(1, 999) is None
+
+
+def test_leaderboard_follows_every_size_change(harness):
+    chat = harness.chat_id
+
+    async def scenario(h):
+        await h.start_players(1, 2, 3, 4)
+        await assert_matches_db(chat)
+
+        for user_id in (1, 2, 3, 4):
+            await h.send(user_id, "/grow")
+        await assert_matches_db(chat)
+
+        await h.send(1, "/casino 1")
+        await assert_matches_db(chat)
+
+        await h.send(1, "/duel", reply_to=2)
+        duel_message = h.session.sent()[-1]
+        await h.click(2, "duel_accept", duel_message.message_id)
+        await assert_matches_db(chat)
+
+        # Guilty verdict, then execute and pardon the defendant.
+        await h.send(1, "/trial", reply_to=3)
+        trial_message = h.session.sent()[-1]
+        await h.click(2, "vote_guilty", trial_message.message_id)
+        await h.click(4, "vote_guilty", trial_message.message_id)
+        await h.expire_trial()
+        await h.send(1, "/execute", reply_to=3)
+        assert await h.size(3) == 0
+        await assert_matches_db(chat)
+        await h.send(2, "/pardon", reply_to=3)
+        assert await h.size(3) > 0
+        await assert_matches_db(chat)
+
+        # Acquittal: the prosecutor pays the penalty.
+        await h.send(2, "/trial", reply_to=4)
+        trial_message = h.session.sent()[-1]
+        await h.click(1, "vote_innocent", trial_message.message_id)
+        await h.expire_trial()
+        await assert_matches_db(chat)
+
+        game = await h.start_blackjack(4, 1, 3)
+        assert game.player_ids == [4, 3]
+        while chat in bot.blackjack_games:
+            player_id = game.current_player_id()
+            if player_id is not None and game.turn_end_time is not None:
+                await h.click(player_id, "blackjack_stand", game.message_id)
+            await h.wait_for(lambda: chat not in bot.blackjack_games or game.turn_end_time is not None)
+        await assert_matches_db(chat)
+
+        # Sizes written behind the leaderboard's back are picked up by the startup rebuild.
+        await bot.adb_query("UPDATE users SET size = ? WHERE user_id = ? AND chat_id = ?",
+                            (bot.PRESTIGE_REQUIREMENT, 1, chat))
+        await bot.load_leaderboard()
+        await assert_matches_db(chat)
+        await h.send(1, "/prestige")
+        assert await h.size(1) == 5
+        await assert_matches_db(chat)
+
+    harness.run(scenario)
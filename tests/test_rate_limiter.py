@@ -0,0 +1,19 @@
+import sys
+
+import bot
+
+
+def test_stats_estimate_matches_a_full_walk():
+    limiter = bot.RateLimiter(1000, 600)
+    for user_id in range(1500):
+        limiter.allow((-100, user_id, "spam"), 1, 10)
+        limiter.allow((-100, user_id, "spam"), 1, 10)
+    limiter.allow((-100, 42, "casino"), 5, 60)
+
+    stats = limiter.stats()
+    walked = sys.getsizeof(limiter._buckets) + sum(sys.getsizeof(key) + sys.getsizeof(value)
+                                                   for key, value in limiter._buckets.items())
+    assert stats["entries"] == 1000
+    assert stats["bytes"] == walked
+    assert stats["misses"] == 1501 and stats["hits"] == 1500 and stats["limited"] == 1500
+    assert stats["evicted"] == 501
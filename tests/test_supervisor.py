@@ -0,0 +1,40 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+
+import bot
+
+
+def workers_by_name():
+    return {process.name: process for process in multiprocessing.active_children() if process.name.startswith("worker-")}
+
+
+def test_crashed_worker_is_respawned(tmp_path, monkeypatch):
+    # Spawned workers open wombat.db in the working directory.
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, "WORKER_CHECK_SECONDS", 0.05)
+    respawned = {}
+
+    async def kill_worker_then_stop(route):
+        deadline = asyncio.get_running_loop().time() + 30
+        while len(workers_by_name()) < 2:
+            assert asyncio.get_running_loop().time() < deadline
+            await asyncio.sleep(0.05)
+        crashed = workers_by_name()["worker-0"]
+        os.kill(crashed.pid, signal.SIGKILL)
+        while True:
+            worker = workers_by_name().get("worker-0")
+            if worker is not None and worker.pid != crashed.pid and worker.is_alive():
+                break
+            assert asyncio.get_running_loop().time() < deadline
+            await asyncio.sleep(0.05)
+        respawned.update(old=crashed, new=worker, other=workers_by_name()["worker-1"])
+
+    monkeypatch.setattr(bot, "run_sharded_polling", kill_worker_then_stop)
+    bot.init_db()  # main() creates the schema before it starts the supervisor
+    bot.close_db_connections()
+    asyncio.run(bot.run_supervisor(2))
+
+    assert respawned["old"].exitcode == -signal.SIGKILL
+    assert respawned["new"].exitcode == 0 and respawned["other"].exitcode == 0